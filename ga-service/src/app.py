@@ -1,8 +1,13 @@
 import logging
 
+import connector
 import enums
+import metrics
+import workers
 from config import Config
-from tasks import TaskQueue
+from pipeline import Pipeline
+from tasks import get_task_queue, GeneticAlgorithmTask
+from workers import TaskPool
 
 
 def get_logger() -> logging.Logger:
@@ -36,11 +41,37 @@ logger.info('Environment: {}'.format(Config().environment))
 class App:
     def __init__(self):
         self.logger = logging.getLogger('genetic_algorithm.App')
-        self.tasks = TaskQueue()
+        self.cfg = Config()
+        # the bootstrap sensor and most vendors use the default column, index it before any sensor exists
+        connector.get_connector().ensure_indexes('date_time')
+        if self.cfg.metrics_port:
+            metrics.start_server(self.cfg.metrics_port, self.cfg.metrics_host)
+        self.tasks = get_task_queue()
         self.logger.info('Genetic algorithm app initialized!')
 
     def run(self):
-        [task.run() for task in self.tasks]
+        if self.cfg.workers > 1:
+            self.run_concurrent()
+        elif self.cfg.prefetch > 0 and self.cfg.task_queue == enums.TaskQueueTypes.LOCAL:
+            self.logger.info('Running tasks with {} sensor(s) prefetched'.format(self.cfg.prefetch))
+            Pipeline(self.tasks, self.cfg.prefetch).run()
+        else:
+            for task in self.tasks:
+                result = workers.execute(task)
+                self.tasks.complete(result)
+                workers.record(result)
+                if not result['ok']:
+                    self.logger.error('{} failed: {}'.format(result['key'], result['error']))
+
+    def run_concurrent(self):
+        self.logger.info('Running tasks on {} workers'.format(self.cfg.workers))
+        with TaskPool(self.cfg.workers, on_result=self.tasks.complete) as pool:
+            for task in self.tasks:
+                if isinstance(task, GeneticAlgorithmTask):
+                    pool.submit(task)
+                else:
+                    pool.join()
+                    task.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+"""Compare GA engines on the bootstrap data set.
+
+    python -m benchmarks.ga_engines --generations 500
+"""
+import argparse
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+import engines
+import enums
+from bootstrap.bootstrap import get_data_from_csv, arka_key_dict
+from sensor import TrainingData
+
+
+def load_training_data() -> np.ndarray:
+    data = get_data_from_csv(key_dict=arka_key_dict)
+    fields = list(data[0].keys())
+    sensor = SimpleNamespace(fields=fields, predict='pm10', datetime_col='date_time')
+    return TrainingData.from_data(data, sensor)
+
+
+def mean_absolute_error(training_data: np.ndarray, genotype) -> float:
+    prediction = training_data[:, :-1] @ np.asarray(genotype, dtype=np.float64)
+    return float(np.abs(prediction - training_data[:, -1]).mean())
+
+
+def run(engine_type: enums.EngineTypes, training_data: np.ndarray, generations: int) -> dict:
+    engine_class = engines.get_engine_class(engine_type)
+    started = time.perf_counter()
+    engine = engine_class(training_data, training_data.shape[1])
+    setup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(generations):
+        engine.evolve()
+        best = engine.get_best()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'engine': engine_type.name,
+        'setup_s': setup,
+        'generations_per_s': generations / elapsed,
+        'ms_per_generation': elapsed / generations * 1000,
+        # scored the same way for every engine, the engines' own fitness functions may differ
+        'mae': mean_absolute_error(training_data, engine_class.to_dict(best)['genotype']),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--generations', type=int, default=200)
+    parser.add_argument('--engine', action='append', choices=[e.name for e in enums.EngineTypes],
+                        help='engine to run, can be repeated (default: all installed)')
+    args = parser.parse_args()
+
+    training_data = load_training_data()
+    print('Training data: {} rows x {} columns'.format(*training_data.shape))
+    selected = args.engine or [e.name for e in enums.EngineTypes]
+    for name in selected:
+        engine_type = enums.EngineTypes[name]
+        if engine_type == enums.EngineTypes.RUST and engines.ga is None:
+            print('{:>6}: skipped, ga library not installed'.format(name))
+            continue
+        result = run(engine_type, training_data, args.generations)
+        print('{engine:>6}: setup {setup_s:.3f}s, {generations_per_s:.1f} gen/s, '
+              '{ms_per_generation:.2f} ms/gen, MAE {mae:.3f}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
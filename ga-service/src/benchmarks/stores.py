@@ -0,0 +1,90 @@
+"""Database stand-ins for benchmarks, installed with connector.Connector.use."""
+import copy
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Union
+
+import connector
+from config import Config
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+def matches(document: dict, query: dict) -> bool:
+    # only the query shapes Sensor builds: equality, $exists and $gte
+    for key, condition in query.items():
+        if isinstance(condition, dict):
+            if condition.get('$exists') is True and key not in document:
+                return False
+            if '$gte' in condition and not (key in document and document[key] >= condition['$gte']):
+                return False
+        elif document.get(key) != condition:
+            return False
+    return True
+
+
+class MemoryDB:
+    # the subset of connector.MongoDB used by Sensor for the row layout, without any server
+    def __init__(self):
+        self.cfg = Config()
+        self.collections = defaultdict(list)
+
+    def with_retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def ensure_indexes(self, datetime_col: str):
+        pass
+
+    def save(self, data, collection_name: str, ordered: bool = True):
+        documents = [data] if isinstance(data, dict) else data
+        self.collections[collection_name].extend(copy.copy(document) for document in documents)
+        return SimpleNamespace(inserted_ids=list(range(len(documents))))
+
+    def remove(self, collection_name: str, query: dict = None):
+        if query:
+            self.collections[collection_name] = [document for document in self.collections[collection_name]
+                                                 if not matches(document, query)]
+        else:
+            self.collections[collection_name] = []
+
+    def get(self, quantity: Union[str, int], collection_name: str, query: dict = None, datetime_col: str = 'date_time',
+            projection: dict = None, batch_size: int = None):
+        found = [document for document in self.collections[collection_name] if matches(document, query or {})]
+        found.sort(key=lambda document: document.get(datetime_col, 0), reverse=True)
+        if str(quantity).upper() != 'ALL':
+            found = found[:int(quantity)]
+        if projection:
+            keep = [key for key, value in projection.items() if value]
+            found = [{key: document[key] for key in keep if key in document} for document in found]
+        return iter(found)
+
+
+class MongomockDB(connector.MongoDB):
+    # the real connector code running against mongomock
+    def __init__(self):
+        self._client = mongomock.MongoClient()
+        super().__init__()
+
+    @property
+    def db(self):
+        return self._client.get_database(self.cfg.database_name)
+
+    def connect(self):
+        return True
+
+
+STORES = {
+    'memory': MemoryDB,
+    'mongomock': MongomockDB,
+}
+
+
+def create_store(name: str):
+    if name == 'mongomock' and mongomock is None:
+        raise ImportError('mongomock is not installed, use --store memory')
+    store = STORES[name]()
+    connector.Connector.use(store)
+    return store
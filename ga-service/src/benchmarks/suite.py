@@ -0,0 +1,158 @@
+"""Benchmark the training and serving hot paths on synthetic sensor history.
+
+    python -m benchmarks.suite --rows 50000 --fields 7 --gap-rate 0.02 --output results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+import tracemalloc
+from typing import Callable
+
+import numpy as np
+
+import engines
+import enums
+from benchmarks import stores
+from benchmarks.synthetic import SyntheticHistory
+from bootstrap.bootstrap import chunked
+from config import Config
+from sensor import Sensor, TrainingData
+
+
+def percentiles(latencies: list) -> dict:
+    latencies = np.asarray(latencies) * 1000
+    return {'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+            'mean': float(latencies.mean())}
+
+
+def measure(stage: str, func: Callable, repeats: int, items: int, setup: Callable = None) -> dict:
+    # timings run untraced, peak memory comes from one extra call under tracemalloc
+    latencies = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'stage': stage,
+            'calls': repeats,
+            'items_per_call': items,
+            'throughput_per_s': items * repeats / sum(latencies),
+            'latency_ms': percentiles(latencies),
+            'peak_memory_mb': peak / 2 ** 20}
+
+
+def run(args) -> dict:
+    cfg = Config()
+    cfg.storage_layout = enums.StorageLayouts[args.layout]
+    store = stores.create_store(args.store)
+
+    history = SyntheticHistory(seed=args.seed)
+    readings = history.generate(args.rows, args.fields, args.gap_rate)
+    sensor = Sensor(_id='benchmark', fields=[history.datetime_col] + history.columns(args.fields),
+                    predict=history.predict, vendor='benchmark', vendor_id=0, datetime_col=history.datetime_col)
+    readings = [sensor.to_reading(reading) for reading in readings]
+    results = []
+
+    def clear():
+        store.remove(cfg.data_collection, sensor.query)
+        store.remove(cfg.buckets_collection, sensor.query)
+
+    def insert():
+        for chunk in chunked(readings, cfg.bootstrap_chunk_size):
+            sensor.save_readings(chunk)
+
+    results.append(measure('insert', insert, args.repeats, len(readings), setup=clear))
+
+    columns = {}
+
+    def fetch():
+        columns['timestamps'], columns['values'] = sensor.read_columns()
+
+    results.append(measure('fetch', fetch, args.repeats, len(readings)))
+
+    training = {}
+
+    def pair():
+        training['data'] = TrainingData.from_columns(columns['timestamps'], columns['values'])[1]
+
+    results.append(measure('pair', pair, args.repeats, len(readings)))
+
+    training_data = training['data']
+    engine_type = enums.EngineTypes[args.engine]
+    engine = engines.get_engine_class(engine_type)(training_data, training_data.shape[1])
+    results.append(measure('evolve', engine.evolve, args.generations, 1))
+
+    genotype = np.asarray(engine.to_dict(engine.get_best())['genotype'])
+    feature_columns = list(sensor.fields)
+
+    def predict():
+        # the work of the prediction-service handler: latest reading of the sensor times the genotype
+        latest = next(iter(store.get(1, cfg.data_collection, sensor.query, sensor.datetime_col)), None)
+        if latest is not None:
+            float(np.dot(genotype, [latest[field] for field in feature_columns]))
+
+    if cfg.storage_layout == enums.StorageLayouts.ROWS:
+        results.append(measure('predict', predict, args.predictions, 1))
+
+    return {'meta': {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'store': args.store,
+                     'layout': args.layout,
+                     'engine': args.engine,
+                     'rows': len(readings),
+                     'training_rows': len(training_data),
+                     'fields': args.fields,
+                     'gap_rate': args.gap_rate,
+                     'seed': args.seed},
+            'stages': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--fields', type=int, default=7, help='feature columns, pm10 included')
+    parser.add_argument('--gap-rate', type=float, default=0.02, help='fraction of missing hourly readings')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--generations', type=int, default=200)
+    parser.add_argument('--predictions', type=int, default=200)
+    parser.add_argument('--store', choices=sorted(stores.STORES),
+                        default='mongomock' if stores.mongomock else 'memory')
+    parser.add_argument('--layout', choices=[layout.name for layout in enums.StorageLayouts], default='ROWS')
+    parser.add_argument('--engine', choices=[engine.name for engine in enums.EngineTypes], default='NUMPY')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+    if args.layout == 'BUCKETS' and args.store == 'memory':
+        parser.error('the memory store only implements the row layout, use --store mongomock')
+
+    report = run(args)
+    for result in report['stages']:
+        print('{stage:>8}: {throughput_per_s:>12.1f} items/s, p50 {p50:.2f} ms, p99 {p99:.2f} ms, '
+              'peak {peak_memory_mb:.1f} MB'.format(**result, **result['latency_ms']))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Synthetic sensor histories shaped like the bootstrap data set."""
+import math
+from typing import List
+
+import numpy as np
+
+from bootstrap.bootstrap import get_data_from_csv, arka_key_dict
+
+
+class SyntheticHistory:
+    # every column is an AR(1) process with the mean, deviation and lag-1 correlation of its daneArka counterpart
+    START = 1325376000  # 2012-01-01, where the bootstrap data starts
+
+    def __init__(self, seed: int = 0):
+        data = get_data_from_csv(key_dict=arka_key_dict)
+        self.datetime_col = 'date_time'
+        self.predict = 'pm10'
+        self.base_columns = [column for column in data[0] if column != self.datetime_col]
+        matrix = np.array([[row[column] for column in self.base_columns] for row in data])
+        timestamps = np.array([row[self.datetime_col] for row in data], dtype=np.float64)
+
+        self.mean = matrix.mean(axis=0)
+        self.std = matrix.std(axis=0)
+        centered = matrix - self.mean
+        correlation = (centered[1:] * centered[:-1]).mean(axis=0) / np.maximum(self.std ** 2, 1e-12)
+        self.phi = np.clip(correlation, 0, 0.99)
+        self.step = float(np.median(np.diff(np.sort(timestamps))))
+        self.rng = np.random.default_rng(seed)
+
+    def columns(self, fields: int) -> List[str]:
+        # the first columns are the real ones, extra fields reuse their statistics under new names
+        names = list(self.base_columns[:fields])
+        names.extend('field_{}'.format(i) for i in range(len(names), fields))
+        if self.predict not in names:
+            names[-1] = self.predict
+        return names
+
+    def generate(self, rows: int, fields: int = 7, gap_rate: float = 0.0) -> List[dict]:
+        columns = self.columns(fields)
+        source = [self.base_columns.index(column) if column in self.base_columns else i % len(self.base_columns)
+                  for i, column in enumerate(columns)]
+        mean, std, phi = self.mean[source], self.std[source], self.phi[source]
+
+        # a little slack so that at least `rows` slots survive the random gaps
+        slots = int(math.ceil(rows / max(1 - gap_rate, 1e-3) * 1.1)) + 10
+        kept = np.flatnonzero(self.rng.random(slots) >= gap_rate)[:rows]
+        noise = self.rng.standard_normal((slots, len(columns))) * std * np.sqrt(1 - phi ** 2)
+        values = np.empty((slots, len(columns)))
+        values[0] = mean + self.rng.standard_normal(len(columns)) * std
+        for t in range(1, slots):
+            values[t] = mean + phi * (values[t - 1] - mean) + noise[t]
+
+        timestamps = self.START + kept * self.step
+        readings = []
+        for timestamp, row in zip(timestamps.tolist(), np.round(values[kept], 1).tolist()):
+            reading = dict(zip(columns, row))
+            reading[self.datetime_col] = int(timestamp)
+            readings.append(reading)
+        return readings
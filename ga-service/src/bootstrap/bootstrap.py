@@ -1,7 +1,15 @@
 import csv
+import itertools
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import List, Iterable, Iterator, Callable
+
+module_logger = logging.getLogger('genetic_algorithm.bootstrap')
+
+FAST_DT_FORMAT = "%Y-%m-%d %H:%M"
 
 d_key_dict = {
     'Czas Pomiaru': 'date_time',
@@ -15,15 +23,23 @@ d_key_dict = {
 
 }
 
+arka_key_dict = {
+    'date': 'date_time',
+    'pm10': 'pm10',
+    'wind direction': 'wind_direction',
+    'wind strength': 'wind',
+    'temp': 'temperature',
+    'humidity': 'humidity',
+    'dew point': 'dew_point',
+    'air pres.': 'pressure'
+}
+
 
 def csv_repair(filename):
-    final = []
-    with open(filename, 'r') as f:
-        for line in f.readlines():
-            final.append('20' + line)
     repaired_name = "{}_fixed".format(filename)
-    with open(repaired_name, 'w') as f:
-        f.writelines(final)
+    with open(filename, 'r') as src, open(repaired_name, 'w') as dst:
+        for line in src:
+            dst.write('20' + line)
     return repaired_name
 
 
@@ -38,20 +54,62 @@ def export_data_from_xls(filename, db, key_dict):
     pass
 
 
-def get_data_from_csv(filename=get_abs_path('daneArka.csv'), key_dict=d_key_dict, delimiter=',',
-                      dt_format="%Y-%m-%d %H:%M") -> List[dict]:
-    result = []
-    with open(filename, 'r') as f:
+def parse_datetime(value: str, dt_format: str = FAST_DT_FORMAT) -> int:
+    # slicing the fixed-width default format is several times faster than strptime
+    if dt_format == FAST_DT_FORMAT and len(value) == 16 and value[4] == '-' and value[13] == ':':
+        return int(datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16])).timestamp())
+    return int(datetime.strptime(value, dt_format).timestamp())
+
+
+def iter_csv(filename=get_abs_path('daneArka.csv'), key_dict=d_key_dict, delimiter=',',
+             dt_format=FAST_DT_FORMAT) -> Iterator[dict]:
+    with open(filename, 'r', newline='') as f:
         reader = csv.DictReader(f, delimiter=delimiter)
         for r in reader:
-            temp_dict = {}
             if '' in r.values():
                 continue
+            temp_dict = {}
             for k, v in key_dict.items():
                 if v == 'date_time':
-                    temp_dict[v] = int(datetime.strptime(r.get(k).strip(), dt_format).timestamp())
+                    temp_dict[v] = parse_datetime(r.get(k).strip(), dt_format)
                 else:
-                    temp_dict[v] = r.get(k).strip().replace(',', '.')
+                    temp_dict[v] = float(r.get(k).strip().replace(',', '.'))
+            yield temp_dict
+
+
+def chunked(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_data_from_csv(filename=get_abs_path('daneArka.csv'), key_dict=d_key_dict, delimiter=',',
+                      dt_format=FAST_DT_FORMAT) -> List[dict]:
+    return list(iter_csv(filename, key_dict, delimiter, dt_format))
+
+
+def import_csv(filename: str, write: Callable[[List[dict]], None], key_dict=d_key_dict, delimiter=',',
+               dt_format=FAST_DT_FORMAT, chunk_size: int = 5000) -> int:
+    started = time.perf_counter()
+    count = 0
+    for chunk in chunked(iter_csv(filename, key_dict, delimiter, dt_format), chunk_size):
+        write(chunk)
+        count += len(chunk)
+    elapsed = time.perf_counter() - started
+    module_logger.info('Imported {} rows from {} in {:.1f}s ({:.0f} rows/s)'.format(
+        count, filename, elapsed, count / elapsed if elapsed else 0))
+    return count
+
 
-            result.append(temp_dict)
-    return result
+def import_csvs(filenames: List[str], write: Callable[[List[dict]], None], workers: int = 4, **kwargs) -> int:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(filenames)))) as executor:
+        count = sum(executor.map(lambda filename: import_csv(filename, write, **kwargs), filenames))
+    elapsed = time.perf_counter() - started
+    module_logger.info('Imported {} rows from {} files in {:.1f}s ({:.0f} rows/s)'.format(
+        count, len(filenames), elapsed, count / elapsed if elapsed else 0))
+    return count
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import time
+from typing import Optional, List
+
+import numpy as np
+
+import enums
+from config import Config
+
+module_logger = logging.getLogger('genetic_algorithm.cache')
+
+
+class TrainingSetCache:
+    # rows are stored as raw float64: [source timestamp, *fields, predict]
+
+    def __init__(self, sensor, name: str = None):
+        self.logger = logging.getLogger('genetic_algorithm.cache.TrainingSetCache')
+        self.cfg = Config()
+        self.columns = [sensor.datetime_col] + list(sensor.fields) + [sensor.predict]
+        self.width = len(self.columns)
+
+        name = name or sensor.id
+        os.makedirs(self.cfg.cache_dir, exist_ok=True)
+        self.data_path = os.path.join(self.cfg.cache_dir, '{}.bin'.format(name))
+        self.meta_path = os.path.join(self.cfg.cache_dir, '{}.json'.format(name))
+        self.meta = self._read_meta()
+
+    @property
+    def high_water_mark(self) -> Optional[float]:
+        return self.meta.get('high_water_mark')
+
+    def since(self, overlap: float) -> Optional[float]:
+        if self.high_water_mark is None:
+            return None
+        return self.high_water_mark - overlap
+
+    def update(self, sources: np.ndarray, training_data: np.ndarray, high_water_mark: float, since: float = None):
+        # pairs with a source at or after `since` were rebuilt from the refetched overlap and replace cached ones
+        rows = np.empty((len(sources), self.width))
+        rows[:, 0] = sources
+        rows[:, 1:] = training_data
+
+        offset = 0
+        cached = self._memmap() if since is not None else None
+        if cached is not None:
+            offset = int(np.searchsorted(cached[:, 0], since, side='left')) * self.width * 8
+            del cached
+
+        with open(self.data_path, 'a+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(rows.tobytes())
+
+        self.meta = {'columns': self.columns, 'high_water_mark': float(high_water_mark)}
+        self._write_meta()
+        self.logger.debug('Cache {} updated with {} rows'.format(self.data_path, len(rows)))
+
+    def load(self) -> np.ndarray:
+        cached = self._memmap()
+        if cached is None:
+            return np.empty((0, self.width - 1))
+        return cached[:, 1:]
+
+    def clear(self):
+        for path in (self.data_path, self.meta_path):
+            if os.path.isfile(path):
+                os.remove(path)
+        self.meta = {}
+
+    def _memmap(self) -> Optional[np.memmap]:
+        if not os.path.isfile(self.data_path):
+            return None
+        rows = os.path.getsize(self.data_path) // (self.width * 8)
+        if not rows:
+            return None
+        return np.memmap(self.data_path, dtype=np.float64, mode='r', shape=(rows, self.width))
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            self.logger.warning('Invalid cache metadata {}, rebuilding: {}'.format(self.meta_path, e))
+            self.clear()
+            return {}
+        if meta.get('columns') != self.columns:
+            self.logger.info('Sensor columns changed, rebuilding cache {}'.format(self.data_path))
+            self.clear()
+            return {}
+        return meta
+
+    def _write_meta(self):
+        tmp_path = '{}.tmp'.format(self.meta_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+
+class Checkpoint:
+    # individuals are stored as a genotype matrix and a fitness vector, anything else the engine reports as json
+
+    def __init__(self, sensor, name: str = None):
+        self.logger = logging.getLogger('genetic_algorithm.cache.Checkpoint')
+        self.cfg = Config()
+        self.interval = self.cfg.checkpoint_interval
+        self.interval_type = self.cfg.save_interval_type
+        self.generations = 0
+        self._last_time = time.time()
+        self._last_generation = 0
+
+        os.makedirs(self.cfg.checkpoint_dir, exist_ok=True)
+        self.path = os.path.join(self.cfg.checkpoint_dir, '{}.npz'.format(name or sensor.id))
+
+    def due(self, generations: int) -> bool:
+        if not self.interval:
+            return False
+        if self.interval_type == enums.SaveIntervalTypes.GENERATION:
+            return generations - self._last_generation >= self.interval
+        return time.time() - self._last_time >= self.interval
+
+    def save(self, individuals: List[dict], generations: int):
+        genotypes = np.array([individual['genotype'] for individual in individuals], dtype=np.float64)
+        fitness = np.array([individual['fitness'] for individual in individuals], dtype=np.float64)
+        extra = [{k: v for k, v in individual.items() if k not in ('genotype', 'fitness')}
+                 for individual in individuals]
+        tmp_path = '{}.tmp.npz'.format(self.path[:-len('.npz')])
+        np.savez_compressed(tmp_path, genotypes=genotypes, fitness=fitness,
+                            generations=generations, extra=json.dumps(extra))
+        os.replace(tmp_path, self.path)
+        self._last_time = time.time()
+        self._last_generation = generations
+        self.logger.debug('Checkpoint {} saved at generation {} with {} individuals'.format(
+            self.path, generations, len(individuals)))
+
+    def load(self) -> List[dict]:
+        if not os.path.isfile(self.path):
+            return []
+        try:
+            with np.load(self.path) as checkpoint:
+                genotypes = checkpoint['genotypes']
+                fitness = checkpoint['fitness']
+                extra = json.loads(str(checkpoint['extra']))
+                self.generations = int(checkpoint['generations'])
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning('Invalid checkpoint {}, ignoring: {}'.format(self.path, e))
+            self.clear()
+            return []
+        self._last_generation = self.generations
+        self.logger.info('Resuming from checkpoint {} at generation {}'.format(self.path, self.generations))
+        individuals = []
+        for genotype, value, rest in zip(genotypes, fitness, extra):
+            individual = dict(rest)
+            individual.update({'genotype': genotype.tolist(), 'fitness': float(value)})
+            individuals.append(individual)
+        return individuals
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.generations = 0
@@ -18,12 +18,26 @@ class Config:
         'save_interval_type': {'type': enums.SaveIntervalTypes, 'default': enums.SaveIntervalTypes.TIME},
         'initial_population_size': {'type': int, 'default': 200},
         'crossover_type': {'type': str, 'default': None},
+        'engine': {'type': enums.EngineTypes, 'default': enums.EngineTypes.RUST},
+        'fitness_sample_size': {'type': int, 'default': None},
         'max_age': {'type': int, 'default': 7},
         'pass_best': {'type': bool, 'default': True},
+        'warm_start_size': {'type': int, 'default': 10},
         'max_generation': {'type': int, 'default': None},
+        'stagnation_generations': {'type': int, 'default': None},
+        'min_improvement': {'type': float, 'default': 0.0},
+        'target_fitness': {'type': float, 'default': None},
+        'time_budget': {'type': int, 'default': None},
         'max_children_size': {'type': int, 'default': 50},
+        'workers': {'type': int, 'default': 1},
+        'prefetch': {'type': int, 'default': 1},
+        'islands': {'type': int, 'default': 1},
+        'migration_interval': {'type': int, 'default': 100},
         'time_interval': {'type': int, 'default': 1},
         'time_unit': {'type': enums.TimeUnitTypes, 'default': enums.TimeUnitTypes.H},
+        'schedule_refresh': {'type': int, 'default': 60},
+        'metrics_port': {'type': int, 'default': None},
+        'metrics_host': {'type': str, 'default': '0.0.0.0'},
         'log_level': {'type': enums.LoggerLevels, 'default': enums.LoggerLevels.INFO},
         'crossover_chance': {'type': float, 'default': 0.8},
         'mutation_chance': {'type': float, 'default': 0.9},
@@ -34,12 +48,34 @@ class Config:
         'database_user': {'type': str, 'default': None},
         'database_password': {'type': str, 'default': None},
         'database_name': {'type': str, 'default': 'sensors'},
+        'database_pool_size': {'type': int, 'default': 10},
+        'database_connect_timeout': {'type': int, 'default': 5000},
+        'database_server_selection_timeout': {'type': int, 'default': 5000},
+        'database_socket_timeout': {'type': int, 'default': 60000},
+        'retry_attempts': {'type': int, 'default': 5},
+        'retry_base_delay': {'type': float, 'default': 0.1},
+        'retry_max_delay': {'type': float, 'default': 5.0},
         'table_name': {'type': str, 'default': None},
         'config_collection': {'type': str, 'default': 'config'},
         'individuals_collection': {'type': str, 'default': 'individuals'},
         'data_collection': {'type': str, 'default': 'data'},
+        'buckets_collection': {'type': str, 'default': 'buckets'},
+        'predictions_collection': {'type': str, 'default': 'predictions'},
+        'storage_layout': {'type': enums.StorageLayouts, 'default': enums.StorageLayouts.ROWS},
+        'bucket_span': {'type': enums.BucketSpans, 'default': enums.BucketSpans.DAY},
+        'cursor_batch_size': {'type': int, 'default': 5000},
+        'bootstrap_chunk_size': {'type': int, 'default': 5000},
+        'bootstrap_workers': {'type': int, 'default': 4},
         'environment': {'type': enums.EnvironmentTypes, 'default': enums.EnvironmentTypes.DEV},
         'redis_url': {'type': str, 'default': 'redis://localhost'},
+        'redis_prefix': {'type': str, 'default': 'ga'},
+        'task_queue': {'type': enums.TaskQueueTypes, 'default': enums.TaskQueueTypes.LOCAL},
+        'task_lease': {'type': int, 'default': 60},
+        'task_poll_interval': {'type': float, 'default': 1.0},
+        'training_cache': {'type': bool, 'default': True},
+        'cache_dir': {'type': str, 'default': os.path.join(module_location, 'cache')},
+        'checkpoint_interval': {'type': int, 'default': 300},
+        'checkpoint_dir': {'type': str, 'default': os.path.join(module_location, 'cache', 'checkpoints')},
     }
 
     @staticmethod
@@ -1,20 +1,131 @@
+import functools
 import logging
+import os
 import threading
-from typing import Union
+from collections import defaultdict
+from typing import Union, List, Optional
 
 import pymongo
+from pymongo import monitoring
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, ExecutionTimeout, PyMongoError
 
 import enums
+import metrics
 from config import Config
+from decorators import retry, RetryStats
 
 module_logger = logging.getLogger('genetic_algorithm.connector')
 
 
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'created': 0, 'closed': 0, 'checked_out': 0, 'checkout_failed': 0, 'cleared': 0}
+        self.in_use = 0
+
+    def _count(self, name: str, in_use: int = 0):
+        with self._lock:
+            self.counters[name] += 1
+            self.in_use += in_use
+        metrics.connections.inc(event=name)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count('cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count('closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count('checkout_failed')
+
+    def connection_checked_out(self, event):
+        self._count('checked_out', 1)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def to_dict(self) -> dict:
+        return dict(self.counters, in_use=self.in_use)
+
+
+class ExportedRetryStats(RetryStats):
+    def record(self, name: str):
+        super().record(name)
+        metrics.retries.inc(outcome=name)
+
+
+pool_metrics = PoolMetrics()
+retry_stats = ExportedRetryStats()
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(connection_string: str) -> pymongo.MongoClient:
+    # one pooled client per process, clients inherited through fork are never reused
+    key = (os.getpid(), connection_string)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                cfg = Config()
+                client = pymongo.MongoClient(connection_string,
+                                             maxPoolSize=cfg.database_pool_size,
+                                             connectTimeoutMS=cfg.database_connect_timeout,
+                                             serverSelectionTimeoutMS=cfg.database_server_selection_timeout,
+                                             socketTimeoutMS=cfg.database_socket_timeout,
+                                             event_listeners=[pool_metrics])
+                _clients[key] = client
+    return client
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, (ConnectionFailure, ExecutionTimeout)):
+        return True
+    return isinstance(error, PyMongoError) and (error.has_error_label('RetryableWriteError') or
+                                                error.has_error_label('TransientTransactionError'))
+
+
+def transient_retry(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with metrics.query_seconds.time(operation=func.__name__):
+            return self.retrying(func)(self, *args, **kwargs)
+
+    return wrapper
+
+
 class MongoDB:
     def __init__(self):
         self.logger = logging.getLogger('genetic_algorithm.connector.MongoDB')
         self.cfg = Config()
-        self.db = None
+        self._indexed = set()
+        self.retrying = retry(PyMongoError,
+                              attempts=self.cfg.retry_attempts,
+                              base_delay=self.cfg.retry_base_delay,
+                              max_delay=self.cfg.retry_max_delay,
+                              retry_if=is_transient,
+                              stats=retry_stats,
+                              logger=self.logger)
         self.logger.info('{} instantiated'.format(__class__.__name__))
 
         self.connect()
@@ -27,51 +138,191 @@ class MongoDB:
             self.cfg.database_port
         )
 
+    @property
+    def db(self):
+        return get_client(self.get_connection_string()).get_database(self.cfg.database_name)
+
     def connect(self):
         try:
-            db_client = pymongo.MongoClient(self.get_connection_string())
-            self.db = db_client.get_database(self.cfg.database_name)
+            get_client(self.get_connection_string())
         except Exception as e:
             self.logger.error(e)
             return False
         return True
 
+    @transient_retry
+    def ping(self):
+        self.db.command('ping')
+
     def test(self):
-        if not self.connect():
-            raise ConnectionError
+        try:
+            self.ping()
+        except PyMongoError as e:
+            raise ConnectionError(e)
+
+    def with_retry(self, func, *args, **kwargs):
+        with metrics.query_seconds.time(operation=func.__name__):
+            return self.retrying(func)(*args, **kwargs)
 
-    def save(self, data, collection_name: str):
+    @staticmethod
+    def metrics() -> dict:
+        return {'pool': pool_metrics.to_dict(), 'retry': retry_stats.to_dict()}
+
+    def save(self, data, collection_name: str, ordered: bool = True):
+        # inserts are not retried here, a repeat after a partial write fails on the _ids set by the first attempt,
+        # pymongo's retryable writes already retry a single failed insert safely
         if isinstance(data, dict):
             return self.db[collection_name].insert_one(data)
         elif isinstance(data, list) and isinstance(data[0], dict):
-            return self.db[collection_name].insert_many(data)
+            return self.db[collection_name].insert_many(data, ordered=ordered)
         else:
             raise ValueError
 
+    @transient_retry
     def remove(self, collection_name: str, query: dict = None):
         if query:
             self.db[collection_name].delete_many(query)
         else:
             self.db[collection_name].delete_many({})
 
-    def get(self, quantity: Union[str, int], collection_name: str, query: dict = None, datetime_col: str = 'date_time'):
+    def get(self, quantity: Union[str, int], collection_name: str, query: dict = None, datetime_col: str = 'date_time',
+            projection: dict = None, batch_size: int = None):
         if query is None:
             query = {}
-        while True:
-            try:
-                if str(quantity).upper() == 'ALL':
-                    data = self.db[collection_name].find(query).sort([(datetime_col, -1)])
-                else:
-                    quantity = int(quantity)
-                    data = self.db[collection_name].find(query).sort([(datetime_col, -1)]).limit(quantity)
-                return data
-            except Exception as e:
-                self.logger.error(e)
-                self.connect()
+        # find is lazy, callers consuming the cursor wrap the whole read in with_retry
+        data = self.db[collection_name].find(query, projection).sort([(datetime_col, -1)])
+        if str(quantity).upper() != 'ALL':
+            data = data.limit(int(quantity))
+        if batch_size:
+            data = data.batch_size(batch_size)
+        return data
 
     def get_data_by_time(self, how_long, unit):
         pass
 
+    def save_buckets(self, collection_name: str, sensor_id, readings: List[dict], datetime_col: str, span: int,
+                     columns: List[str]):
+        # one upsert per (sensor, bucket start) appends every column at once, $push is not idempotent so no retry
+        # every column of the sensor schema is pushed, missing values as None, to stay aligned with the timestamps
+        buckets = defaultdict(list)
+        for reading in readings:
+            timestamp = reading[datetime_col]
+            buckets[int(timestamp // span * span)].append(reading)
+        columns = list(dict.fromkeys([datetime_col] + list(columns)))
+        operations = []
+        for start, rows in buckets.items():
+            timestamps = [row[datetime_col] for row in rows]
+            operations.append(pymongo.UpdateOne(
+                {'sensor_id': sensor_id, 'start': start},
+                {'$set': {'span': span},
+                 '$min': {'min_ts': min(timestamps)},
+                 '$max': {'max_ts': max(timestamps)},
+                 '$inc': {'count': len(rows)},
+                 '$push': {'columns.{}'.format(column): {'$each': [row.get(column) for row in rows]}
+                           for column in columns}},
+                upsert=True))
+        if not operations:
+            return None
+        return self.db[collection_name].bulk_write(operations, ordered=False)
+
+    def get_buckets(self, collection_name: str, query: dict, since: Optional[float] = None,
+                    batch_size: int = None):
+        query = dict(query)
+        if since is not None:
+            query['max_ts'] = {'$gte': since}
+        data = self.db[collection_name].find(query, {'_id': False}).sort([('start', pymongo.ASCENDING)])
+        if batch_size:
+            data = data.batch_size(batch_size)
+        return data
+
+    def latest_bucket(self, collection_name: str, query: dict) -> Optional[dict]:
+        return self.db[collection_name].find_one(query, {'_id': False}, sort=[('start', pymongo.DESCENDING)])
+
+    @transient_retry
+    def save_prediction(self, collection_name: str, prediction: dict) -> bool:
+        # only replaces a prediction computed from older or the same inputs, a newer one makes the upsert
+        # collide with the unique (sensor_id, horizon) index and is kept
+        query = {'sensor_id': prediction['sensor_id'],
+                 'horizon': prediction['horizon'],
+                 'reading_ts': {'$lte': prediction['reading_ts']},
+                 'individual_ts': {'$lte': prediction['individual_ts']}}
+        try:
+            self.db[collection_name].replace_one(query, prediction, upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    @transient_retry
+    def top_individuals(self, collection_name: str, sensor_ids: list, k: int, query: dict = None,
+                        datetime_col: str = 'date_time') -> dict:
+        # best k individuals by fitness for every sensor in a single round trip, $topN keeps only k documents
+        # per sensor while grouping instead of collecting a sensor's whole history first
+        match = dict(query or {}, sensor_id={'$in': sensor_ids}, fitness={'$ne': None})
+        documents = self.db[collection_name].aggregate([
+            {'$match': match},
+            {'$project': {'_id': False, 'horizon': False, datetime_col: False}},
+            {'$group': {'_id': '$sensor_id', 'individuals': {'$topN': {
+                'n': k, 'sortBy': {'fitness': pymongo.ASCENDING}, 'output': '$$ROOT'}}}},
+        ])
+        return {document['_id']: document['individuals'] for document in documents}
+
+    @transient_retry
+    def collection_stats(self, collection_name: str) -> dict:
+        stats = self.db.command('collStats', collection_name)
+        return {key: stats.get(key, 0) for key in ('count', 'size', 'storageSize', 'totalIndexSize')}
+
+    @transient_retry
+    def convert_to_double(self, collection_name: str, query: dict, fields: List[str]) -> int:
+        # server side string -> double conversion, accepts both '92.7' and '92,7', a missing field stays missing
+        as_double = {field: {'$convert': {
+            'input': {'$replaceAll': {'input': {'$toString': '$' + field}, 'find': ',', 'replacement': '.'}},
+            'to': 'double',
+            'onError': '$' + field,
+            'onNull': '$' + field,
+        }} for field in fields}
+        query = dict(query, **{'$or': [{field: {'$type': 'string'}} for field in fields]})
+        return self.db[collection_name].update_many(query, [{'$set': as_double}]).modified_count
+
+    @transient_retry
+    def ensure_indexes(self, datetime_col: str):
+        if datetime_col in self._indexed:
+            return
+        for collection_name in (self.cfg.data_collection, self.cfg.individuals_collection):
+            collection = self.db[collection_name]
+            collection.create_index([('sensor_id', pymongo.ASCENDING), (datetime_col, pymongo.DESCENDING)])
+            plan = collection.find({'sensor_id': None}).sort([(datetime_col, -1)]).limit(1).explain()
+            if self.uses_collscan(plan['queryPlanner']['winningPlan']):
+                raise RuntimeError('Query on {} by sensor_id sorted by {} still uses COLLSCAN'.format(
+                    collection_name, datetime_col))
+        self._indexed.add(datetime_col)
+        self.logger.info('Indexes on (sensor_id, {} desc) ready'.format(datetime_col))
+        if 'predictions' not in self._indexed:
+            predictions = self.db[self.cfg.predictions_collection]
+            # one stored prediction per sensor and horizon, the single horizon index predates horizons
+            if 'sensor_id_1' in predictions.index_information():
+                predictions.drop_index('sensor_id_1')
+            predictions.create_index([('sensor_id', pymongo.ASCENDING), ('horizon', pymongo.ASCENDING)], unique=True)
+            self._indexed.add('predictions')
+            self.logger.info('Index on predictions (sensor_id, horizon) ready')
+        if 'fitness' not in self._indexed:
+            self.db[self.cfg.individuals_collection].create_index(
+                [('sensor_id', pymongo.ASCENDING), ('horizon', pymongo.ASCENDING), ('fitness', pymongo.ASCENDING)])
+            self._indexed.add('fitness')
+            self.logger.info('Index on individuals (sensor_id, horizon, fitness) ready')
+        if self.cfg.storage_layout == enums.StorageLayouts.BUCKETS and 'buckets' not in self._indexed:
+            self.db[self.cfg.buckets_collection].create_index(
+                [('sensor_id', pymongo.ASCENDING), ('start', pymongo.DESCENDING)], unique=True)
+            self._indexed.add('buckets')
+            self.logger.info('Index on buckets (sensor_id, start desc) ready')
+
+    @staticmethod
+    def uses_collscan(plan) -> bool:
+        if isinstance(plan, dict):
+            return plan.get('stage') == 'COLLSCAN' or any(MongoDB.uses_collscan(v) for v in plan.values())
+        if isinstance(plan, list):
+            return any(MongoDB.uses_collscan(v) for v in plan)
+        return False
+
 
 class Connector:
     __instance = None
@@ -91,6 +342,17 @@ class Connector:
                     raise Exception("Not Implemented Connector {}\nUse can use MongoDB instead".format(cfg.database_type.name))
         return Connector.__instance
 
+    @staticmethod
+    def reset():
+        with Connector.__lock:
+            Connector.__instance = None
+
+    @staticmethod
+    def use(instance):
+        # lets benchmarks swap in an in-memory stand-in for the database
+        with Connector.__lock:
+            Connector.__instance = instance
+
 
 def get_connector():
     return Connector()
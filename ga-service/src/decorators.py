@@ -1,4 +1,12 @@
-from time import clock
+import functools
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+module_logger = logging.getLogger('genetic_algorithm.decorators')
 
 
 def print_generator(func):
@@ -19,12 +27,13 @@ def logger(func):
 
 
 def timer(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        before = clock()
+        before = time.perf_counter()
         rv = func(*args, **kwargs)
-        after = clock()
-        # print(func.__name__, 'elapsed', after - before)
-        print('%s elapsed %.7f' % (func.__name__, after - before))
+        after = time.perf_counter()
+        metrics.function_seconds.observe(after - before, function=func.__qualname__)
+        module_logger.debug('%s elapsed %.7f' % (func.__qualname__, after - before))
         return rv
 
     return wrapper
@@ -45,3 +54,52 @@ def until_not_none(func):
         return rv
 
     return wrapper
+
+
+class RetryStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def record(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def to_dict(self) -> dict:
+        return {'calls': self.calls, 'retries': self.retries, 'failures': self.failures}
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    # full jitter: uniform in [0, min(max_delay, base_delay * 2^attempt)]
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry(exceptions=Exception, attempts: int = 5, base_delay: float = 0.1, max_delay: float = 5.0,
+          retry_if=None, stats: RetryStats = None, logger=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if stats:
+                stats.record('calls')
+            for attempt in range(attempts):
+                try:
+                    return func(*args, **kwargs)
+                except exceptions as e:
+                    transient = retry_if is None or retry_if(e)
+                    if not transient or attempt + 1 >= attempts:
+                        if stats:
+                            stats.record('failures')
+                        raise
+                    delay = backoff_delay(attempt, base_delay, max_delay)
+                    if stats:
+                        stats.record('retries')
+                    if logger:
+                        logger.warning('{} failed ({}), retry {}/{} in {:.2f}s'.format(
+                            func.__name__, e, attempt + 1, attempts - 1, delay))
+                    time.sleep(delay)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,285 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import List
+
+import numpy as np
+
+import enums
+from config import Config
+
+try:
+    import ga
+except ImportError:
+    ga = None
+
+module_logger = logging.getLogger('genetic_algorithm.engines')
+rust_logger = logging.getLogger('genetic_algorithm.external_lib.ga')
+
+
+class Engine(ABC):
+    def __init__(self, training_data: np.ndarray, row_size: int):
+        self.cfg = Config()
+        self.training_data = training_data
+        self.row_size = row_size
+
+    @abstractmethod
+    def evolve(self):
+        pass
+
+    @abstractmethod
+    def get_best(self):
+        pass
+
+    @abstractmethod
+    def add_individual(self, individual):
+        pass
+
+    @abstractmethod
+    def individuals(self) -> List[dict]:
+        pass
+
+    def validate(self, individual) -> float:
+        # fitness comparable across generations, engines scoring on a changing subsample rescore on fixed rows
+        return individual.fitness
+
+    def finalize(self, best):
+        # engines scoring on a subsample return best rescored on the full training data
+        return best
+
+    @staticmethod
+    @abstractmethod
+    def to_dict(individual) -> dict:
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def from_dict(dct: dict):
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def from_genotype(genotype, fitness: float = None, extra: dict = None):
+        pass
+
+
+class RustEngine(Engine):
+    def __init__(self, training_data: np.ndarray, row_size: int):
+        super().__init__(training_data, row_size)
+        if ga is None:
+            raise ImportError('Rust ga library is not installed, use ENGINE=NUMPY instead')
+        if self.cfg.fitness_sample_size:
+            module_logger.warning('Rust engine always scores the full training data, fitness_sample_size ignored')
+        self._archive = []
+        # the binding takes python lists and keeps its own copy, islands on this engine cannot share the
+        # training data and each hold a full copy of it
+        self._population = ga.Population(training_data.tolist(),
+                                         row_size,
+                                         logger=rust_logger,
+                                         initial_population_size=self.cfg.initial_population_size,
+                                         max_age=self.cfg.max_age,
+                                         max_children_size=self.cfg.max_children_size,
+                                         mutation_chance=self.cfg.mutation_chance,
+                                         crossover_chance=self.cfg.crossover_chance)
+
+    def evolve(self):
+        self._population.evolve()
+
+    def get_best(self):
+        best = self._population.get_best()
+        if not self._archive or best.fitness < self._archive[-1]['fitness']:
+            self._archive.append(self.to_dict(best))
+            del self._archive[:-self.cfg.initial_population_size]
+        return best
+
+    def add_individual(self, individual):
+        self._population.add_individual(individual)
+
+    def individuals(self) -> List[dict]:
+        # the binding only exposes its best, so snapshots carry the archive of improving bests
+        return list(self._archive)
+
+    @staticmethod
+    def to_dict(individual) -> dict:
+        return individual.to_json()
+
+    @staticmethod
+    def from_dict(dct: dict):
+        individual = ga.Individual.from_json(json.dumps(dct))
+        individual.logger = rust_logger
+        return individual
+
+    @staticmethod
+    def from_genotype(genotype, fitness: float = None, extra: dict = None):
+        # the binding only builds individuals from json, extra keeps whatever else to_json stored
+        dct = dict(extra or {})
+        dct.update({'genotype': list(genotype), 'fitness': fitness})
+        return RustEngine.from_dict(dct)
+
+
+class Individual:
+    def __init__(self, genotype, fitness: float = None, age: int = 0):
+        self.genotype = np.asarray(genotype, dtype=np.float64)
+        self.fitness = fitness
+        self.age = age
+
+    def __eq__(self, other):
+        return isinstance(other, Individual) and np.array_equal(self.genotype, other.genotype)
+
+    def __repr__(self):
+        return 'Individual(fitness={}, genotype={})'.format(self.fitness, self.genotype.tolist())
+
+    def to_json(self) -> dict:
+        return {'genotype': self.genotype.tolist(), 'fitness': self.fitness}
+
+    @staticmethod
+    def from_json(json_str: str) -> 'Individual':
+        dct = json.loads(json_str)
+        return Individual(dct['genotype'], dct.get('fitness'))
+
+
+class StratifiedSampler:
+    # one row from each of sample_size contiguous strata, the position inside a stratum rotates every call
+    STEP = 7919
+
+    def __init__(self, size: int, sample_size: int):
+        bounds = np.linspace(0, size, sample_size + 1).astype(np.int64)
+        self.starts = bounds[:-1]
+        self.lengths = np.diff(bounds)
+        self.offset = 0
+
+    def next(self) -> np.ndarray:
+        rows = self.starts + self.offset % self.lengths
+        self.offset += self.STEP
+        return rows
+
+
+class NumpyEngine(Engine):
+    # fitness is the mean absolute error of features @ genotype against the target column, lower is better
+    FINAL_CANDIDATES = 10
+
+    def __init__(self, training_data: np.ndarray, row_size: int, seed: int = None):
+        super().__init__(training_data, row_size)
+        self.rng = np.random.default_rng(seed)
+        # views into the training data, islands keep reading the shared memory block instead of a copy
+        training_data = np.asarray(training_data, dtype=np.float64)
+        self.features = training_data[:, :-1]
+        self.target = training_data[:, -1]
+        self.sampler = None
+        sample_size = self.cfg.fitness_sample_size
+        if sample_size and sample_size < len(self.target):
+            self.sampler = StratifiedSampler(len(self.target), sample_size)
+            rows = np.linspace(0, len(self.target) - 1, sample_size).astype(np.int64)
+            self._validation_features, self._validation_target = self.features[rows], self.target[rows]
+        self._next_batch()
+        self._seeds = []
+        # genes start around the scale that maps each feature onto the target
+        scale = np.abs(self.target).mean() / np.maximum(np.abs(self.features).mean(axis=0), 1e-12)
+        self.genotypes = self.rng.uniform(-1, 1, (self.cfg.initial_population_size, row_size - 1)) * scale
+        self.fitness = self.score(self.genotypes)
+        self.ages = np.zeros(len(self.genotypes), dtype=np.int64)
+
+    def _next_batch(self):
+        if self.sampler is None:
+            self._batch_features, self._batch_target = self.features, self.target
+        else:
+            rows = self.sampler.next()
+            self._batch_features, self._batch_target = self.features[rows], self.target[rows]
+
+    def score(self, genotypes: np.ndarray, full: bool = False) -> np.ndarray:
+        features, target = (self.features, self.target) if full else (self._batch_features, self._batch_target)
+        return np.abs(features @ genotypes.T - target[:, None]).mean(axis=0)
+
+    def evolve(self):
+        if self.sampler is not None:
+            self._next_batch()
+            self.fitness = self.score(self.genotypes)
+        children = self.cfg.max_children_size
+        first = self._tournament(children)
+        second = self._tournament(children)
+
+        offspring = self.genotypes[first].copy()
+        crossing = self.rng.random(children) < self.cfg.crossover_chance
+        alpha = self.rng.random((int(crossing.sum()), self.row_size - 1))
+        offspring[crossing] = alpha * offspring[crossing] + (1 - alpha) * self.genotypes[second[crossing]]
+
+        mutating = self.rng.random(children) < self.cfg.mutation_chance
+        genes = self.rng.integers(0, self.row_size - 1, int(mutating.sum()))
+        sigma = self.genotypes.std(axis=0)[genes] + np.abs(offspring[mutating, genes]) * 1e-3 + 1e-12
+        offspring[mutating, genes] += self.rng.normal(0, 1, len(genes)) * sigma
+
+        self.genotypes = np.vstack([self.genotypes, offspring])
+        self.fitness = np.concatenate([self.fitness, self.score(offspring)])
+        self.ages = np.concatenate([self.ages + 1, np.zeros(children, dtype=np.int64)])
+        # seeds, migrants and restored checkpoints only compete for a place, the population stays capped
+        self._select(self.cfg.initial_population_size)
+
+    def _tournament(self, n: int) -> np.ndarray:
+        candidates = self.rng.integers(0, len(self.genotypes), (n, 2))
+        better = self.fitness[candidates[:, 0]] <= self.fitness[candidates[:, 1]]
+        return np.where(better, candidates[:, 0], candidates[:, 1])
+
+    def _select(self, size: int):
+        alive = self.ages <= self.cfg.max_age
+        if self.cfg.pass_best:
+            alive[np.argmin(self.fitness)] = True
+        survivors = np.flatnonzero(alive)
+        survivors = survivors[np.argsort(self.fitness[survivors], kind='stable')[:size]]
+        self.genotypes = self.genotypes[survivors]
+        self.fitness = self.fitness[survivors]
+        self.ages = self.ages[survivors]
+
+    def get_best(self) -> Individual:
+        best = int(np.argmin(self.fitness))
+        return Individual(self.genotypes[best].copy(), float(self.fitness[best]), int(self.ages[best]))
+
+    def add_individual(self, individual: Individual):
+        genotype = np.asarray(individual.genotype, dtype=np.float64)[None, :]
+        self._seeds.append(genotype)
+        self.genotypes = np.vstack([self.genotypes, genotype])
+        self.fitness = np.concatenate([self.fitness, self.score(genotype)])
+        self.ages = np.append(self.ages, 0)
+
+    def individuals(self) -> List[dict]:
+        return [{'genotype': genotype.tolist(), 'fitness': float(fitness)}
+                for genotype, fitness in zip(self.genotypes, self.fitness)]
+
+    def validate(self, individual: Individual) -> float:
+        if self.sampler is None:
+            return individual.fitness
+        genotype = np.asarray(individual.genotype, dtype=np.float64)
+        return float(np.abs(self._validation_features @ genotype - self._validation_target).mean())
+
+    def finalize(self, best: Individual) -> Individual:
+        if self.sampler is None:
+            return best
+        candidates = np.argsort(self.fitness, kind='stable')[:self.FINAL_CANDIDATES]
+        # seeds such as the previous best take part, a batch-best that is worse on the full data never replaces them
+        genotypes = np.vstack([self.genotypes[candidates], best.genotype[None, :]] + self._seeds)
+        fitness = self.score(genotypes, full=True)
+        winner = int(np.argmin(fitness))
+        return Individual(genotypes[winner].copy(), float(fitness[winner]))
+
+    @staticmethod
+    def to_dict(individual: Individual) -> dict:
+        return individual.to_json()
+
+    @staticmethod
+    def from_dict(dct: dict) -> Individual:
+        return Individual(dct['genotype'], dct.get('fitness'))
+
+    @staticmethod
+    def from_genotype(genotype, fitness: float = None, extra: dict = None) -> Individual:
+        return Individual(genotype, fitness)
+
+
+ENGINES = {
+    enums.EngineTypes.RUST: RustEngine,
+    enums.EngineTypes.NUMPY: NumpyEngine,
+}
+
+
+def get_engine_class(engine_type: enums.EngineTypes = None):
+    if engine_type is None:
+        engine_type = Config().engine
+    return ENGINES[engine_type]
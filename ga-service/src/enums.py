@@ -36,6 +36,10 @@ class TimeUnitTypes(Enum):
     D = 4
     DAYS = 4
 
+    @property
+    def seconds(self) -> int:
+        return {1: 1, 2: 60, 3: 60 * 60, 4: 24 * 60 * 60}[self.value]
+
 
 class DatabaseTypes(Enum):
     MYSQL = 1
@@ -47,5 +51,36 @@ class DatabaseTypes(Enum):
     MONGO = MONGODB
 
 
+class StopReasons(Enum):
+    MAX_GENERATION = 1
+    STAGNATION = 2
+    TARGET_FITNESS = 3
+    TIME_BUDGET = 4
+
+
+class EngineTypes(Enum):
+    RUST = 1
+    NUMPY = 2
+
+
+class StorageLayouts(Enum):
+    ROWS = 1
+    BUCKETS = 2
+
+
+class TaskQueueTypes(Enum):
+    LOCAL = 1
+    REDIS = 2
+
+
+class BucketSpans(Enum):
+    DAY = 1
+    WEEK = 2
+
+    @property
+    def seconds(self) -> int:
+        return {1: 24 * 60 * 60, 2: 7 * 24 * 60 * 60}[self.value]
+
+
 class CrossingOverTypes(Enum):
     pass
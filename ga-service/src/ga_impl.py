@@ -1,46 +1,245 @@
 import logging
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
 from typing import List, Optional
 
-import ga
+import numpy as np
 
+import engines
+import enums
+from cache import Checkpoint
 from config import Config
 
 
 class GeneticAlgorithm:
-    def __init__(self, training_data: List[list], row_size: int):
+    def __init__(self, training_data: np.ndarray, row_size: int):
         self.logger = logging.getLogger('genetic_algorithm.ga_impl.GeneticAlgorithm')
         self._training_data = training_data
         self._row_size = row_size
         self.cfg = Config()
+        self.generations = 0
+        self.elapsed = 0.0
+        self.stop_reason = None
 
-        self._population = ga.Population(training_data,
-                                         row_size,
-                                         logger=logging.getLogger('genetic_algorithm.external_lib.ga'),
-                                         initial_population_size=self.cfg.initial_population_size,
-                                         max_age=self.cfg.max_age,
-                                         max_children_size=self.cfg.max_children_size,
-                                         mutation_chance=self.cfg.mutation_chance,
-                                         crossover_chance=self.cfg.crossover_chance)
+        self._population = engines.get_engine_class()(training_data, row_size)
 
-    def evolve(self, n: int = None) -> ga.Individual:
+    def evolve(self, n: int = None, checkpoint: Checkpoint = None):
         best = None
-        if not n and self.cfg.max_generation:
-            n = self.cfg.max_generation
-        elif not n:
-            n = 1000
-        for i in range(n):
+        best_fitness = None
+        n = self.max_generation(n)
+        stop = StopCondition(generations=checkpoint.generations if checkpoint else 0)
+        n = max(n, stop.generations + 1)
+        for i in range(stop.generations, n):
             self._population.evolve()
-            if best:
-                if self.get_best().fitness < best.fitness:
-                    best = self.get_best()
-                    self.logger.debug('Current best at iteration {}: {}'.format(i, best))
-            else:
-                best = self.get_best()
+            current = self.get_best()
+            # mini-batch scores differ per batch, tracking and stopping use a score comparable across generations
+            fitness = self._population.validate(current)
+            if best is None or fitness < best_fitness:
+                best, best_fitness = current, fitness
+                self.logger.debug('Current best at iteration {}: {}'.format(i, best))
+            if stop.update(fitness):
+                break
+            if checkpoint and checkpoint.due(stop.generations):
+                checkpoint.save(self.individuals(), stop.generations)
+        best = self._population.finalize(best)
+        self.generations = stop.generations
+        self.elapsed = stop.elapsed
+        self.stop_reason = stop.reason or enums.StopReasons.MAX_GENERATION
         self.logger.info('Best individual: {}'.format(best))
+        self.logger.info('Stopped after {} generations in {:.1f}s: {}'.format(
+            self.generations, self.elapsed, self.stop_reason.name))
         return best
 
+    def step(self, n: int):
+        for _ in range(n):
+            self._population.evolve()
+        return self._population.finalize(self.get_best())
+
+    @staticmethod
+    def max_generation(n: int = None) -> int:
+        cfg = Config()
+        if not n and cfg.max_generation:
+            n = cfg.max_generation
+        elif not n:
+            n = 1000
+        return n
+
+    @staticmethod
+    def to_dict(individual) -> dict:
+        return engines.get_engine_class().to_dict(individual)
+
+    @staticmethod
+    def from_dict(dct: dict):
+        return engines.get_engine_class().from_dict(dct)
+
+    @staticmethod
+    def from_genotype(genotype, fitness: float = None, extra: dict = None):
+        return engines.get_engine_class().from_genotype(genotype, fitness, extra)
+
     def get_best(self):
         return self._population.get_best()
 
-    def add(self, individual: ga.Individual):
+    def individuals(self) -> List[dict]:
+        return self._population.individuals()
+
+    def add(self, individual):
         self._population.add_individual(individual)
+
+
+class StopCondition:
+    def __init__(self, generations: int = 0):
+        self.cfg = Config()
+        self.started = time.time()
+        self.generations = generations
+        self.stagnant = 0
+        self.best_fitness = None
+        # last best that improved by more than min_improvement, slow steady gains add up against it
+        self.reference_fitness = None
+        self.reason = None
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started
+
+    def update(self, fitness: float, generations: int = 1) -> bool:
+        self.generations += generations
+        if self.best_fitness is None:
+            self.best_fitness = self.reference_fitness = fitness
+        else:
+            self.best_fitness = min(self.best_fitness, fitness)
+            if self.improvement(self.reference_fitness, self.best_fitness) > self.cfg.min_improvement:
+                self.reference_fitness = self.best_fitness
+                self.stagnant = 0
+            else:
+                self.stagnant += generations
+
+        if self.cfg.target_fitness is not None and self.best_fitness <= self.cfg.target_fitness:
+            self.reason = enums.StopReasons.TARGET_FITNESS
+        elif self.cfg.stagnation_generations and self.stagnant >= self.cfg.stagnation_generations:
+            self.reason = enums.StopReasons.STAGNATION
+        elif self.cfg.time_budget and self.elapsed >= self.cfg.time_budget:
+            self.reason = enums.StopReasons.TIME_BUDGET
+        return self.reason is not None
+
+    @staticmethod
+    def improvement(previous: float, current: float) -> float:
+        if not previous:
+            return float('inf')
+        return (previous - current) / abs(previous)
+
+
+def run_island(index: int, shm_name: str, shape: tuple, row_size: int, seeds: List[dict],
+               commands: multiprocessing.Queue, results: multiprocessing.Queue):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        training_data = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        population = GeneticAlgorithm(training_data, row_size)
+        for seed in seeds:
+            population.add(GeneticAlgorithm.from_dict(seed))
+        while True:
+            command = commands.get()
+            if command is None:
+                break
+            generations, migrants = command
+            for migrant in migrants:
+                population.add(GeneticAlgorithm.from_dict(migrant))
+            best = population.step(generations)
+            results.put((index, GeneticAlgorithm.to_dict(best)))
+        # the buffer can only be released once nothing references it
+        del population, training_data
+    finally:
+        shm.close()
+
+
+class IslandModel:
+    def __init__(self, training_data: np.ndarray, row_size: int):
+        self.logger = logging.getLogger('genetic_algorithm.ga_impl.IslandModel')
+        self._training_data = np.ascontiguousarray(training_data, dtype=np.float64)
+        self._row_size = row_size
+        self.cfg = Config()
+        self.islands = self.cfg.islands
+        self.generations = 0
+        self.elapsed = 0.0
+        self.stop_reason = None
+        self._seeds = []
+        self._bests = []
+
+    def add(self, individual):
+        self._seeds.append(GeneticAlgorithm.to_dict(individual))
+
+    def individuals(self) -> List[dict]:
+        return list(self._bests)
+
+    def evolve(self, n: int = None, checkpoint: Checkpoint = None):
+        n = GeneticAlgorithm.max_generation(n)
+        shm = shared_memory.SharedMemory(create=True, size=max(self._training_data.nbytes, 1))
+        shared = np.ndarray(self._training_data.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = self._training_data
+
+        context = multiprocessing.get_context()
+        results = context.Queue()
+        commands = [context.Queue() for _ in range(self.islands)]
+        processes = [context.Process(target=run_island,
+                                     args=(i, shm.name, shared.shape, self._row_size, self._seeds,
+                                           commands[i], results))
+                     for i in range(self.islands)]
+        for process in processes:
+            process.start()
+        self.logger.info('Started {} islands, migration every {} generations'.format(
+            self.islands, self.cfg.migration_interval))
+
+        best = None
+        stop = StopCondition(generations=checkpoint.generations if checkpoint else 0)
+        n = max(n, stop.generations + 1)
+        migrants = [[] for _ in range(self.islands)]
+        try:
+            while stop.generations < n:
+                epoch = min(self.cfg.migration_interval, n - stop.generations)
+                for command_queue, island_migrants in zip(commands, migrants):
+                    command_queue.put((epoch, island_migrants))
+                bests = self._bests = self._collect(results, processes)
+                # ring topology: every island receives the best of its neighbour
+                migrants = [[bests[i - 1]] for i in range(self.islands)]
+                epoch_best = min(bests, key=lambda individual: individual['fitness'])
+                if best is None or epoch_best['fitness'] < best['fitness']:
+                    best = epoch_best
+                    self.logger.debug('Current best at generation {}: {}'.format(stop.generations + epoch, best))
+                if stop.update(epoch_best['fitness'], epoch):
+                    break
+                if checkpoint and checkpoint.due(stop.generations):
+                    checkpoint.save(self.individuals(), stop.generations)
+        finally:
+            for command_queue in commands:
+                command_queue.put(None)
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+            del shared
+            shm.close()
+            shm.unlink()
+
+        self.generations = stop.generations
+        self.elapsed = stop.elapsed
+        self.stop_reason = stop.reason or enums.StopReasons.MAX_GENERATION
+        self.logger.info('Best individual: {}'.format(best))
+        self.logger.info('Stopped after {} generations in {:.1f}s: {}'.format(
+            self.generations, self.elapsed, self.stop_reason.name))
+        return GeneticAlgorithm.from_dict(best)
+
+    def _collect(self, results: multiprocessing.Queue, processes: List[multiprocessing.Process]) -> List[dict]:
+        bests = [None] * len(processes)
+        pending = len(processes)
+        while pending:
+            try:
+                index, individual = results.get(timeout=1)
+            except queue.Empty:
+                dead = [i for i, process in enumerate(processes) if not process.is_alive()]
+                if dead:
+                    raise RuntimeError('Islands {} died'.format(dead))
+                continue
+            bests[index] = individual
+            pending -= 1
+        return bests
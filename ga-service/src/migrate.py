@@ -0,0 +1,65 @@
+"""One-off data migrations.
+
+    python migrate.py typed-readings    convert string readings to doubles
+    python migrate.py buckets           copy per-row readings into time bucket documents
+"""
+import argparse
+import logging
+
+import app  # noqa: F401 sets up the genetic_algorithm log handlers
+from bootstrap.bootstrap import chunked
+from config import Config
+from connector import get_connector
+from sensor import Sensor
+
+logger = logging.getLogger('genetic_algorithm.migrate')
+
+
+def typed_readings():
+    cfg = Config()
+    con = get_connector()
+    for document in con.get('ALL', cfg.config_collection):
+        sensor = Sensor()
+        sensor.update(document)
+        fields = [field for field in sensor.columns if field != sensor.datetime_col]
+        modified = con.convert_to_double(cfg.data_collection, sensor.query, fields)
+        logger.info('Sensor {}: converted {} readings'.format(sensor.id, modified))
+
+
+def buckets():
+    # rebuilds the buckets of every sensor from the row collection, rows are left in place
+    cfg = Config()
+    con = get_connector()
+    span = cfg.bucket_span.seconds
+    con.ensure_indexes('date_time')
+    con.db[cfg.buckets_collection].create_index([('sensor_id', 1), ('start', -1)], unique=True)
+    for document in con.get('ALL', cfg.config_collection):
+        sensor = Sensor()
+        sensor.update(document)
+        con.remove(cfg.buckets_collection, sensor.query)
+        rows = 0
+        for chunk in chunked(sensor.get_data(), cfg.cursor_batch_size):
+            con.save_buckets(cfg.buckets_collection, sensor.id, chunk, sensor.datetime_col, span, sensor.columns)
+            rows += len(chunk)
+        documents = con.db[cfg.buckets_collection].count_documents(sensor.query)
+        logger.info('Sensor {}: {} readings packed into {} {} buckets'.format(
+            sensor.id, rows, documents, cfg.bucket_span.name))
+    for collection_name in (cfg.data_collection, cfg.buckets_collection):
+        logger.info('{}: {}'.format(collection_name, con.collection_stats(collection_name)))
+
+
+MIGRATIONS = {
+    'typed-readings': typed_readings,
+    'buckets': buckets,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('migration', choices=sorted(MIGRATIONS))
+    args = parser.parse_args()
+    MIGRATIONS[args.migration]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import workers
+from tasks import TaskQueue, GeneticAlgorithmTask
+
+
+class Pipeline:
+    # single process runner: i/o threads prepare upcoming due sensors and store finished ones while this
+    # thread evolves, pymongo releases the gil while waiting on the network so both overlap with the ga
+
+    def __init__(self, tasks: TaskQueue, prefetch: int = 1):
+        self.logger = logging.getLogger('genetic_algorithm.pipeline.Pipeline')
+        self.tasks = tasks
+        self.prefetch = prefetch
+        self._io = None
+        self._ahead = deque()
+        self._writes = {}
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.prefetch + 1, thread_name_prefix='ga-io') as self._io:
+            try:
+                while True:
+                    if not self._ahead:
+                        task = next(self.tasks)
+                        if not isinstance(task, GeneticAlgorithmTask):
+                            self.drain()
+                            self._record(workers.execute(task))
+                            continue
+                        self._start(task)
+                    while len(self._ahead) <= self.prefetch:
+                        task = self.tasks.pop_due()
+                        if task is None:
+                            break
+                        self._start(task)
+                    self._train(*self._ahead.popleft())
+            finally:
+                self.drain()
+
+    def drain(self):
+        for future in list(self._writes.values()):
+            future.result()
+        self._writes.clear()
+
+    def _start(self, task: GeneticAlgorithmTask):
+        # the previous store of the same sensor must land before its history is read again
+        pending = self._writes.pop(task.key, None)
+        if pending is not None:
+            pending.result()
+        for key in [key for key, future in self._writes.items() if future.done()]:
+            del self._writes[key]
+        self._ahead.append((task, time.time(), self._io.submit(task.prepare)))
+
+    def _train(self, task: GeneticAlgorithmTask, started: float, prepared: Future):
+        try:
+            payload = prepared.result()
+            trained = task.train(payload) if payload is not None else None
+        except Exception as e:
+            self.logger.exception('{} failed'.format(task.key))
+            self._record({'key': task.key, 'ok': False, 'error': repr(e), 'summary': None,
+                          'elapsed': time.time() - started})
+            return
+        self._writes[task.key] = self._io.submit(self._store, task, started, payload, trained)
+
+    def _store(self, task: GeneticAlgorithmTask, started: float, payload, trained) -> dict:
+        result = {'key': task.key, 'ok': True, 'error': None, 'summary': None}
+        try:
+            if payload is not None:
+                result['summary'] = task.store(payload, trained)
+        except Exception as e:
+            self.logger.exception('{} failed'.format(task.key))
+            result.update({'ok': False, 'error': repr(e)})
+        result['elapsed'] = time.time() - started
+        self._record(result)
+        return result
+
+    def _record(self, result: dict):
+        workers.record(result)
+        if result['ok']:
+            self.logger.info('{} completed in {:.1f}s: {}'.format(
+                result['key'], result['elapsed'], result.get('summary')))
+        else:
+            self.logger.error('{} failed: {}'.format(result['key'], result['error']))
@@ -0,0 +1,239 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+
+from bson import json_util
+
+import metrics
+from config import Config
+from sensor import Sensor
+from tasks import TaskQueue, GeneticAlgorithmTask
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class RedisTaskQueue(TaskQueue):
+    # the schedule lives in redis and is shared by every node, one elected node enqueues due sensors and any
+    # node claims them under a lease that a background thread keeps alive while the task runs
+    #
+    #   <prefix>:scheduler  leader node id, expires after one lease
+    #   <prefix>:schedule   zset key -> next due time
+    #   <prefix>:tasks      hash key -> sensor document
+    #   <prefix>:ready      list of keys waiting for a worker
+    #   <prefix>:queued     set of keys in ready, a key is never enqueued twice
+    #   <prefix>:leases     zset key -> lease expiry, a running key is not enqueued or claimed again
+    #   <prefix>:owners     hash key -> node holding the lease
+    #
+    # tests can pass a fakeredis.FakeRedis(decode_responses=True) as client
+
+    def __init__(self, client=None):
+        self.cfg = Config()
+        if client is None:
+            if redis is None:
+                raise ImportError('redis is not installed, install it or set TASK_QUEUE=LOCAL')
+            client = redis.Redis.from_url(self.cfg.redis_url, decode_responses=True)
+        self.redis = client
+        self.node = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease = self.cfg.task_lease
+        self.held = set()
+        self.is_leader = False
+        self._keys = {name: '{}:{}'.format(self.cfg.redis_prefix, name)
+                      for name in ('scheduler', 'schedule', 'tasks', 'ready', 'queued', 'leases', 'owners')}
+        self._stopped = threading.Event()
+        super().__init__()
+        self.logger = logging.getLogger('genetic_algorithm.redis_queue.RedisTaskQueue')
+        self.logger.info('Node {} joined task queue {}'.format(self.node, self.cfg.redis_prefix))
+        self.tick()
+        threading.Thread(target=self._maintain, name='ga-lease', daemon=True).start()
+
+    def __next__(self):
+        if self.tasks:
+            return self.tasks.pop(0)
+        while True:
+            task = self.claim()
+            if task is not None:
+                return task
+            time.sleep(self.cfg.task_poll_interval)
+
+    def pop_due(self):
+        # claims are only released through complete, the prefetching pipeline is not used with this queue
+        return None
+
+    def close(self):
+        self._stopped.set()
+        for key in list(self.held):
+            self.release(key)
+
+    def complete(self, result: dict):
+        self.release(result['key'])
+
+    def generate_tasks(self):
+        # every node builds the local schedule on start, only the leader publishes it
+        super().generate_tasks()
+        if self.is_leader:
+            self.publish()
+
+    def tick(self):
+        self.heartbeat(time.time())
+        self.schedule()
+
+    def schedule(self):
+        if not self.elect():
+            return
+        if time.time() >= self._next_refresh:
+            self.refresh()
+        now = time.time()
+        self.reap(now)
+        self.enqueue_due(now)
+        metrics.queue_depth.set(self.redis.llen(self._keys['ready']))
+
+    def maintain(self):
+        # leases are extended first and on their own, a failing schedule refresh must not let them expire
+        try:
+            self.heartbeat(time.time())
+        except Exception as e:
+            self.logger.warning('Lease heartbeat failed: {}'.format(e))
+        try:
+            self.schedule()
+        except Exception:
+            self.logger.exception('Task scheduling failed')
+
+    def _maintain(self):
+        while not self._stopped.wait(max(self.lease / 3, 1)):
+            self.maintain()
+
+    def elect(self) -> bool:
+        key = self._keys['scheduler']
+
+        def renew(pipe):
+            if pipe.get(key) != self.node:
+                return False
+            pipe.multi()
+            pipe.expire(key, self.lease)
+            return True
+
+        leader = bool(self.redis.set(key, self.node, nx=True, ex=self.lease)) \
+            or self.redis.transaction(renew, key, value_from_callable=True)
+        if leader != self.is_leader:
+            self.logger.info('Node {} {} the scheduler'.format(self.node, 'is now' if leader else 'is no longer'))
+            self.is_leader = leader
+            self._next_refresh = 0
+        return leader
+
+    def publish(self):
+        definitions = {key: json_util.dumps(task.sensor.to_dict()) for key, task in self._scheduled.items()}
+        stale = set(self.redis.hkeys(self._keys['tasks'])) - set(definitions)
+        pipe = self.redis.pipeline()
+        if stale:
+            pipe.hdel(self._keys['tasks'], *stale)
+            pipe.zrem(self._keys['schedule'], *stale)
+        if definitions:
+            pipe.hset(self._keys['tasks'], mapping=definitions)
+            pipe.zadd(self._keys['schedule'], dict.fromkeys(definitions, time.time()), nx=True)
+        pipe.execute()
+
+    def enqueue_due(self, now: float):
+        for key, due in self.redis.zrangebyscore(self._keys['schedule'], '-inf', now, withscores=True):
+            def enqueue(pipe):
+                skip = pipe.sismember(self._keys['queued'], key) or pipe.zscore(self._keys['leases'], key) is not None
+                pipe.multi()
+                if not skip:
+                    pipe.sadd(self._keys['queued'], key)
+                    pipe.rpush(self._keys['ready'], key)
+                pipe.zadd(self._keys['schedule'], {key: max(due + self.interval, now)}, xx=True)
+                return skip
+
+            if self.redis.transaction(enqueue, self._keys['queued'], self._keys['leases'], value_from_callable=True):
+                self.logger.debug('{} is still queued or running, skipping'.format(key))
+            else:
+                metrics.queue_lag.set(now - due)
+
+    def claim(self) -> Optional[GeneticAlgorithmTask]:
+        while True:
+            now = time.time()
+
+            def pop(pipe):
+                key = pipe.lindex(self._keys['ready'], 0)
+                if key is None:
+                    return None, False
+                running = pipe.zscore(self._keys['leases'], key) is not None
+                pipe.multi()
+                pipe.lpop(self._keys['ready'])
+                pipe.srem(self._keys['queued'], key)
+                if not running:
+                    pipe.zadd(self._keys['leases'], {key: now + self.lease})
+                    pipe.hset(self._keys['owners'], key, self.node)
+                return key, running
+
+            key, running = self.redis.transaction(pop, self._keys['ready'], self._keys['leases'],
+                                                  value_from_callable=True)
+            if key is None:
+                return None
+            if running:
+                self.logger.debug('{} is already running on another node, dropped'.format(key))
+                continue
+            self.held.add(key)
+            definition = self.redis.hget(self._keys['tasks'], key)
+            if definition is None:
+                self.logger.info('{} was removed from the schedule, dropped'.format(key))
+                self.release(key)
+                continue
+            self.logger.debug('Claimed {}'.format(key))
+            return GeneticAlgorithmTask(sensor=Sensor(**json_util.loads(definition)))
+
+    def heartbeat(self, now: float):
+        for key in list(self.held):
+            def extend(pipe):
+                if pipe.hget(self._keys['owners'], key) != self.node:
+                    return False
+                pipe.multi()
+                pipe.zadd(self._keys['leases'], {key: now + self.lease}, xx=True)
+                return True
+
+            if not self.redis.transaction(extend, self._keys['owners'], value_from_callable=True):
+                self.logger.warning('Lease on {} was lost, another node may run it again'.format(key))
+                self.held.discard(key)
+
+    def release(self, key: str):
+        if key not in self.held:
+            return
+        self.held.discard(key)
+
+        def drop(pipe):
+            if pipe.hget(self._keys['owners'], key) != self.node:
+                return
+            pipe.multi()
+            pipe.zrem(self._keys['leases'], key)
+            pipe.hdel(self._keys['owners'], key)
+
+        self.redis.transaction(drop, self._keys['owners'])
+
+    def reap(self, now: float):
+        # a lease that was not extended belongs to a dead node, its task goes back to the front of the queue
+        for key in self.redis.zrangebyscore(self._keys['leases'], '-inf', now):
+            def requeue(pipe):
+                expiry = pipe.zscore(self._keys['leases'], key)
+                if expiry is None or expiry > now:
+                    return None
+                owner = pipe.hget(self._keys['owners'], key)
+                queued = pipe.sismember(self._keys['queued'], key)
+                pipe.multi()
+                pipe.zrem(self._keys['leases'], key)
+                pipe.hdel(self._keys['owners'], key)
+                if not queued:
+                    pipe.sadd(self._keys['queued'], key)
+                    pipe.lpush(self._keys['ready'], key)
+                return owner or 'unknown node'
+
+            owner = self.redis.transaction(requeue, self._keys['leases'], self._keys['owners'], self._keys['queued'],
+                                           value_from_callable=True)
+            if owner is not None:
+                self.logger.warning('Lease of {} on {} expired, task requeued'.format(key, owner))
+                metrics.tasks_requeued.inc()
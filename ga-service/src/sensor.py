@@ -1,27 +1,40 @@
 import datetime
 import logging
-from typing import Union, Optional, List
+from array import array
+from typing import Union, Optional, List, Iterable, Iterator, Tuple
 
-from ga import Individual
+import numpy as np
 
+import enums
+import metrics
+from cache import TrainingSetCache, Checkpoint
 from config import Config
 from connector import Connector
-from ga_impl import GeneticAlgorithm
+from ga_impl import GeneticAlgorithm, IslandModel
 
+DEFAULT_HORIZON = 24  # hours, the only horizon before sensors declared their own
 
 class Sensor:
-    def __init__(self, _id=None, fields=None, predict=None, vendor=None, vendor_id=None, datetime_col=None):
+    def __init__(self, _id=None, fields=None, predict=None, vendor=None, vendor_id=None, datetime_col=None,
+                 horizons=None):
         self._id = _id
         self.fields = fields
         self.predict = predict
         self.vendor = vendor
         self.vendor_id = vendor_id
         self.datetime_col = datetime_col
+        self.horizons = horizons
 
         self.cfg = Config()
         self.con = Connector()
         self.logger = logging.getLogger('genetic_algorithm.entities.Sensor')
 
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
     @property
     def query(self):
         return {'sensor_id': self.id}
@@ -30,28 +43,107 @@ class Sensor:
     def id(self):
         return self._id
 
+    @property
+    def horizon_list(self) -> list:
+        return list(self.horizons or [DEFAULT_HORIZON])
+
+    def individual_query(self, horizon=DEFAULT_HORIZON) -> dict:
+        return dict(self.query, **Sensor.horizon_query(horizon))
+
+    @staticmethod
+    def horizon_query(horizon=DEFAULT_HORIZON) -> dict:
+        # individuals saved before horizons existed have no horizon field and belong to the default one
+        return {'horizon': {'$in': [horizon, None]} if horizon == DEFAULT_HORIZON else horizon}
+
+    def cache_name(self, horizon=DEFAULT_HORIZON) -> str:
+        return str(self.id) if horizon == DEFAULT_HORIZON else '{}-{}h'.format(self.id, horizon)
+
     def calculate_new_genotype(self):
-        self.logger.info('Collecting data for: {}'.format(self.to_dict()))
-        data = self.get_data()
-        training_data = TrainingData.from_data(data, self)
-        if not training_data:
-            self.logger.warning('Empty training data... Unable to calculate new genotype')
+        prepared = self.prepare()
+        if prepared is None:
             return None
-        row_size = len(training_data[0])
-        self.logger.info('Collected: {} items'.format(len(training_data)))
-
-        self.logger.info('Init of Genetic Algorithm...')
-        ga = GeneticAlgorithm(training_data, row_size=row_size)
-        prev_bests = [best for best in self.get_individual(1)]
-        for individual in prev_bests:
-            ga.add(individual)
-        best = ga.evolve()
-        if any(best == prev for prev in prev_bests):
-            self.logger.info('New best not found.')
-        else:
-            self.logger.info('New best Individual generated!')
-            self.save_individual(best)
+        return self.store(prepared, self.train(prepared))
+
+    def prepare(self) -> Optional[dict]:
+        # database side of a run, safe to call from an i/o thread while another sensor evolves
+        self.logger.info('Collecting data for: {}'.format(self.to_dict()))
+        prepared = {}
+        for horizon, training_data in self.get_training_sets().items():
+            if not len(training_data):
+                self.logger.warning('Empty {}h training data... Unable to calculate new genotype'.format(horizon))
+                continue
+            self.logger.info('Collected: {} items for {}h'.format(len(training_data), horizon))
+            metrics.training_rows.set(len(training_data), sensor=self.id, horizon=horizon)
+
+            prev_bests = self.get_individual_documents(1, horizon)
+            seeds = list(prev_bests)
+            if self.cfg.warm_start_size:
+                top = self.con.top_individuals(self.cfg.individuals_collection, [self.id], self.cfg.warm_start_size,
+                                               Sensor.horizon_query(horizon), self.datetime_col)
+                seeds.extend(document for document in top.get(self.id, [])
+                             if not any(same_genotype(document, seed) for seed in seeds))
+            checkpoint = Checkpoint(self, self.cache_name(horizon)) if self.cfg.checkpoint_interval else None
+            if checkpoint:
+                seeds.extend(checkpoint.load())
+            prepared[horizon] = {'training_data': training_data,
+                                 'prev_bests': prev_bests,
+                                 'seeds': seeds,
+                                 'checkpoint': checkpoint}
+        return prepared or None
+
+    def train(self, prepared: dict) -> dict:
+        # engine objects never leave the calling thread, the result is returned as a dict
+        trained = {}
+        for horizon, payload in prepared.items():
+            training_data = payload['training_data']
+            row_size = training_data.shape[1]
+            self.logger.info('Init of Genetic Algorithm for {}h...'.format(horizon))
+            if self.cfg.islands > 1:
+                ga = IslandModel(training_data, row_size=row_size)
+            else:
+                ga = GeneticAlgorithm(training_data, row_size=row_size)
+            for document in payload['seeds']:
+                ga.add(self.to_individual(document))
+            checkpoint = payload['checkpoint']
+            with metrics.task_seconds.time(phase='evolve'):
+                best = ga.evolve(checkpoint=checkpoint)
+            if checkpoint:
+                checkpoint.clear()
+            trained[horizon] = {'best': GeneticAlgorithm.to_dict(best),
+                                'generations': ga.generations,
+                                'stop_reason': ga.stop_reason.name,
+                                'elapsed': ga.elapsed}
+        return trained
+
+    def store(self, prepared: dict, trained: dict) -> dict:
+        summary = {}
+        for horizon, result in trained.items():
+            best = result['best']
+            rate = result['generations'] / result['elapsed'] if result['elapsed'] else 0.0
+            metrics.generations.inc(result['generations'])
+            metrics.generations_per_second.set(rate, sensor=self.id, horizon=horizon)
+            metrics.best_fitness.set(best['fitness'], sensor=self.id, horizon=horizon)
+            prev_bests = prepared[horizon]['prev_bests']
+            saved = not any(same_genotype(best, prev) or
+                            (prev.get('fitness') is not None and best['fitness'] >= prev['fitness'])
+                            for prev in prev_bests)
+            if saved:
+                self.logger.info('New best {}h Individual generated!'.format(horizon))
+                with metrics.task_seconds.time(phase='save'):
+                    self.save_individual(best, horizon)
+            else:
+                self.logger.info('New best {}h not found.'.format(horizon))
+            with metrics.task_seconds.time(phase='predict'):
+                self.update_prediction(horizon)
+            summary['{}h'.format(horizon)] = {'generations': result['generations'],
+                                              'stop_reason': result['stop_reason'],
+                                              'elapsed': result['elapsed'],
+                                              'generations_per_second': rate,
+                                              'rows': len(prepared[horizon]['training_data']),
+                                              'fitness': best['fitness'],
+                                              'saved': saved}
         self.logger.info('Calculation completed!')
+        return summary
 
     def save(self):
         new_id = self.con.save(self.to_dict(), self.cfg.config_collection).inserted_id
@@ -59,32 +151,74 @@ class Sensor:
         self.logger.info('Saved: {}'.format(self.to_dict()))
         return self
 
-    def save_individual(self, individual: Individual):
-        json = individual.to_json()
-        self.logger.info('Saving individual: {}'.format(json))
+    def save_individual(self, individual, horizon=DEFAULT_HORIZON):
+        json = dict(individual) if isinstance(individual, dict) else GeneticAlgorithm.to_dict(individual)
+        self.logger.info('Saving {}h individual: {}'.format(horizon, json))
         json.update(self.query)
+        json['horizon'] = horizon
         date_time = datetime.datetime.now().timestamp()
         json.update({self.datetime_col: date_time})
         new_id = self.con.save(json, self.cfg.individuals_collection).inserted_id
         json.update({'_id': new_id})
         return json
 
-    def get_individual(self, quantity: Union[str, int] = 1) -> List[Individual]:
-        import json
+    def get_latest_reading(self) -> Optional[dict]:
+        if self.cfg.storage_layout == enums.StorageLayouts.BUCKETS:
+            bucket = self.con.with_retry(self.con.latest_bucket, self.cfg.buckets_collection, self.query)
+            columns = (bucket or {}).get('columns', {})
+            timestamps = columns.get(self.datetime_col) or []
+            if not timestamps:
+                return None
+            i = max(range(len(timestamps)), key=timestamps.__getitem__)
+            return {column: values[i] for column, values in columns.items() if i < len(values)}
+
+        def read_latest():
+            return list(self.con.get(1, self.cfg.data_collection, self.query, self.datetime_col))
+
+        latest = self.con.with_retry(read_latest)
+        return latest[0] if latest else None
+
+    def update_prediction(self, horizon=DEFAULT_HORIZON) -> Optional[dict]:
+        # same arithmetic as Data.predict in prediction-service, which serves the stored value
+        def read_individual():
+            return list(self.con.get(1, self.cfg.individuals_collection, self.individual_query(horizon),
+                                     self.datetime_col))
+
+        individuals = self.con.with_retry(read_individual)
+        reading = self.get_latest_reading()
+        if not individuals or reading is None:
+            return None
+        individual = individuals[0]
+        values = [reading.get(field) for field in self.fields]
+        if any(value is None for value in values):
+            self.logger.warning('Latest reading of {} is incomplete, prediction not updated'.format(self.id))
+            return None
+        prediction = {'sensor_id': self.id,
+                      'horizon': horizon,
+                      'value': sum(g * to_float(v) for g, v in zip(individual['genotype'], values)),
+                      'reading_ts': reading[self.datetime_col],
+                      'individual_ts': individual[self.datetime_col],
+                      'computed_at': datetime.datetime.now().timestamp()}
+        if self.con.save_prediction(self.cfg.predictions_collection, prediction):
+            self.logger.info('{}h prediction updated: {}'.format(horizon, prediction['value']))
+        return prediction
+
+    def get_individual(self, quantity: Union[str, int] = 1, horizon=DEFAULT_HORIZON) -> list:
+        return [self.to_individual(r) for r in self.get_individual_documents(quantity, horizon)]
+
+    def get_individual_documents(self, quantity: Union[str, int] = 1, horizon=DEFAULT_HORIZON) -> List[dict]:
+        projection = {'_id': False, 'sensor_id': False, 'horizon': False, self.datetime_col: False}
 
-        individuals = []
-        result = self.con.get(quantity, self.cfg.individuals_collection, self.query, datetime_col=self.datetime_col)
+        def read_individuals():
+            return list(self.con.get(quantity, self.cfg.individuals_collection, self.individual_query(horizon),
+                                     datetime_col=self.datetime_col, projection=projection))
 
-        for r in result:
-            r.pop('_id')
-            r.pop(self.datetime_col)
-            r.pop('sensor_id')
-            json_str = json.dumps(r)
-            individual = Individual.from_json(json_str)
-            individual.logger = logging.getLogger('genetic_algorithm.external_lib.ga')
-            individuals.append(individual)
+        return self.con.with_retry(read_individuals)
 
-        return individuals
+    def to_individual(self, document: dict):
+        extra = {k: v for k, v in document.items()
+                 if k not in ('genotype', 'fitness', '_id', 'sensor_id', 'horizon', self.datetime_col)}
+        return GeneticAlgorithm.from_genotype(document['genotype'], document.get('fitness'), extra)
 
     def to_dict(self) -> dict:
         dct = {
@@ -94,71 +228,209 @@ class Sensor:
             'vendor_id': self.vendor_id,
             'datetime_col': self.datetime_col
         }
+        if self.horizons:
+            dct['horizons'] = self.horizons
         if self._id:
             dct['_id'] = self.id
         return dct
 
-    def get_data(self, quantity: Union[str, int] = 'ALL'):
-        data = self.con.get(quantity, self.cfg.data_collection, self.query, self.datetime_col)
-        data = filter(lambda row: self.validate(row), data)
-        data = list(data)
-        return data
+    def get_training_data(self, horizon=DEFAULT_HORIZON) -> np.ndarray:
+        return self.get_training_sets([horizon])[horizon]
+
+    def get_training_sets(self, horizons: list = None) -> dict:
+        # one fetch and one sorted column set feed the training sets of every horizon
+        horizons = horizons or self.horizon_list
+        if not self.cfg.training_cache:
+            timestamps, values = self.fetch_columns()
+            with metrics.task_seconds.time(phase='prepare'):
+                return {horizon: training_data for horizon, (_, training_data)
+                        in TrainingData.from_columns_multi(timestamps, values, horizons).items()}
+
+        caches = {horizon: TrainingSetCache(self, self.cache_name(horizon)) for horizon in horizons}
+        sinces = [cache.since(TrainingData.horizon_seconds(horizon) + TrainingData.TOLERANCE)
+                  for horizon, cache in caches.items()]
+        # the overlap of the longest horizon covers every shorter one, an empty cache needs the full history
+        since = None if any(s is None for s in sinces) else min(sinces)
+        if since is None:
+            self.logger.info('Training set cache empty, collecting full history')
+        else:
+            self.logger.info('Training set cache hit, collecting data since: {}'.format(since))
+        timestamps, values = self.fetch_columns(since)
+        with metrics.task_seconds.time(phase='prepare'):
+            if len(timestamps):
+                for horizon, (sources, training_data) in TrainingData.from_columns_multi(
+                        timestamps, values, horizons).items():
+                    caches[horizon].update(sources, training_data, high_water_mark=timestamps[-1], since=since)
+            return {horizon: cache.load() for horizon, cache in caches.items()}
+
+    def fetch_columns(self, since: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        with metrics.task_seconds.time(phase='fetch'):
+            timestamps, values = self.con.with_retry(self.read_columns, since)
+        metrics.rows_fetched.inc(len(timestamps))
+        return timestamps, values
+
+    def read_columns(self, since: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        if self.cfg.storage_layout == enums.StorageLayouts.BUCKETS:
+            buckets = self.con.get_buckets(self.cfg.buckets_collection, self.query, since,
+                                           batch_size=self.cfg.cursor_batch_size)
+            return TrainingData.from_buckets(buckets, self, since)
+        return TrainingData.to_columns(self.get_data(since=since), self)
+
+    def save_readings(self, readings: List[dict]):
+        if self.cfg.storage_layout == enums.StorageLayouts.BUCKETS:
+            return self.con.save_buckets(self.cfg.buckets_collection, self.id, readings, self.datetime_col,
+                                         self.cfg.bucket_span.seconds, self.columns)
+        return self.con.save(readings, self.cfg.data_collection, ordered=False)
+
+    def get_data(self, quantity: Union[str, int] = 'ALL', since: float = None) -> Iterator[dict]:
+        query = dict(self.query)
+        query.update({field: {'$exists': True} for field in self.fields})
+        if since is not None:
+            query[self.datetime_col] = {'$exists': True, '$gte': since}
+        columns = set(self.fields) | {self.predict, self.datetime_col}
+        projection = dict.fromkeys(columns, True)
+        projection['_id'] = False
+        return self.con.get(quantity, self.cfg.data_collection, query, self.datetime_col,
+                            projection=projection, batch_size=self.cfg.cursor_batch_size)
+
+    @property
+    def columns(self) -> List[str]:
+        return list(dict.fromkeys(list(self.fields) + [self.predict]))
+
+    def to_reading(self, row: dict) -> dict:
+        reading = {k: None if row.get(k) is None else to_float(row.get(k))
+                   for k in self.columns if k != self.datetime_col}
+        reading[self.datetime_col] = row.get(self.datetime_col)
+        reading.update(self.query)
+        return reading
 
     def update(self, json: dict):
         for k, v in json.items():
             setattr(self, k, v)
 
     def validate(self, row: dict) -> bool:
-        if all(f in list(row.keys()) for f in self.fields):
+        if all(f in row for f in self.fields):
             return True
         return False
 
 
 class TrainingData:
+    HORIZON = datetime.timedelta(days=1).total_seconds()
+    TOLERANCE = datetime.timedelta(minutes=30).total_seconds()
+
+    @staticmethod
+    def from_data(data: Iterable[dict], sensor: Sensor) -> np.ndarray:
+        timestamps, values = TrainingData.to_columns(data, sensor)
+        return TrainingData.from_columns(timestamps, values)[1]
+
+    @staticmethod
+    def to_columns(data: Iterable[dict], sensor: Sensor) -> Tuple[np.ndarray, np.ndarray]:
+        # returns timestamps sorted ascending and matching rows of [*fields, predict]
+        columns = list(sensor.fields) + [sensor.predict]
+        timestamps = array('d')
+        values = array('d')
+        for row in data:
+            timestamps.append(row.get(sensor.datetime_col))
+            values.extend(to_float(row.get(k)) for k in columns)
+
+        width = len(columns)
+        if not timestamps:
+            return np.empty(0), np.empty((0, width))
+        timestamps = np.frombuffer(timestamps, dtype=np.float64)
+        values = np.frombuffer(values, dtype=np.float64).reshape(-1, width)
+
+        order = np.argsort(timestamps, kind='stable')
+        return timestamps[order], values[order]
+
+    @staticmethod
+    def from_buckets(buckets: Iterable[dict], sensor: Sensor,
+                     since: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        # same output as to_columns, each bucket unpacks its column arrays in one step
+        columns = list(sensor.fields) + [sensor.predict]
+        timestamps = []
+        values = []
+        for bucket in buckets:
+            bucket_columns = bucket.get('columns', {})
+            count = len(bucket_columns.get(sensor.datetime_col, []))
+            timestamps.append(np.array(bucket_columns.get(sensor.datetime_col, []), dtype=np.float64))
+            block = np.empty((count, len(columns)))
+            for i, column in enumerate(columns):
+                block[:, i] = np.array(bucket_columns.get(column, [None] * count), dtype=np.float64)
+            values.append(block)
+
+        if not timestamps:
+            return np.empty(0), np.empty((0, len(columns)))
+        timestamps = np.concatenate(timestamps)
+        values = np.concatenate(values)
+        keep = np.isfinite(timestamps)
+        if since is not None:
+            keep &= timestamps >= since
+        timestamps, values = timestamps[keep], values[keep]
+
+        order = np.argsort(timestamps, kind='stable')
+        return timestamps[order], values[order]
+
+    @staticmethod
+    def horizon_seconds(hours: float) -> float:
+        return datetime.timedelta(hours=hours).total_seconds()
+
+    @staticmethod
+    def from_columns_multi(timestamps: np.ndarray, values: np.ndarray,
+                           horizons: Iterable[float]) -> dict:
+        # every horizon pairs against the same sorted columns, the data is read and sorted once
+        return {horizon: TrainingData.from_columns(timestamps, values, TrainingData.horizon_seconds(horizon))
+                for horizon in horizons}
+
+    @staticmethod
+    def from_columns(timestamps: np.ndarray, values: np.ndarray,
+                     horizon: float = HORIZON) -> Tuple[np.ndarray, np.ndarray]:
+        # returns source timestamps of the pairs and the training matrix
+        source, target = TrainingData.pair(timestamps, horizon)
+        td = np.empty((len(source), values.shape[1]))
+        td[:, :-1] = values[source, :-1]
+        td[:, -1] = values[target, -1]
+        valid = np.isfinite(td).all(axis=1)
+        return timestamps[source][valid], td[valid]
+
     @staticmethod
-    def from_data(data: List[dict], sensor: Sensor) -> List[List[float]]:
-        def to_list(obj: dict, obj_after_24h: dict):
-            lst = [obj.get(k) for k in sensor.fields]
-            lst.append(obj_after_24h.get(sensor.predict))
-            return lst
-
-        def min_date(date):
-            date = datetime.datetime.fromtimestamp(date)
-            date += datetime.timedelta(hours=23, minutes=30)
-            return date.timestamp()
-
-        def max_date(date):
-            date = datetime.datetime.fromtimestamp(date)
-            date += datetime.timedelta(days=1, minutes=30)
-            return date.timestamp()
-
-        def nearest(items, pivot):
-            if items:
-                return min(items, key=lambda x: abs(x.get(sensor.datetime_col) - pivot))
-
-        def equal_date(date):
-            date = datetime.datetime.fromtimestamp(date)
-            date += datetime.timedelta(days=1)
-            return date.timestamp()
-
-        td = []
-        data_size = len(data)
-        if data_size > 1:
-            data.sort(key=lambda x: x.get(sensor.datetime_col))
-        for i in range(data_size):
-            d = data[i]
-            dt = d.get(sensor.datetime_col)
-            max_dt = max_date(dt)
-            min_dt = min_date(dt)
-            j = 0 + i
-            temp = data[j]
-            items = []
-            while temp.get(sensor.datetime_col) < max_dt and j < data_size:
-                temp = data[j]
-                if temp.get(sensor.datetime_col) > min_dt:
-                    items.append(temp)
-                j += 1
-            d_after_24h = nearest(items, equal_date(dt))
-            if d_after_24h:
-                td.append(to_list(d, d_after_24h))
-        return td
+    def pair(timestamps: np.ndarray, horizon: float = HORIZON,
+             tolerance: float = TOLERANCE) -> Tuple[np.ndarray, np.ndarray]:
+        # timestamps must be sorted ascending
+        # each row is paired with the reading nearest to row + horizon within (horizon - tolerance, horizon + tolerance]
+        size = len(timestamps)
+        if not size:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        lower = np.searchsorted(timestamps, timestamps + (horizon - tolerance), side='right')
+        upper = np.searchsorted(timestamps, timestamps + (horizon + tolerance), side='right')
+        pivot = timestamps + horizon
+        right = np.searchsorted(timestamps, pivot, side='left')
+        left = right - 1
+
+        has_left = left >= lower
+        has_right = right < upper
+        left = np.clip(left, 0, size - 1)
+        right = np.clip(right, 0, size - 1)
+        left_distance = np.where(has_left, pivot - timestamps[left], np.inf)
+        right_distance = np.where(has_right, timestamps[right] - pivot, np.inf)
+        # on equal timestamps or equal distances the earliest reading wins
+        left = np.searchsorted(timestamps, timestamps[left], side='left')
+        target = np.where(left_distance <= right_distance, left, right)
+
+        found = has_left | has_right
+        return np.nonzero(found)[0], target[found]
+
+
+def same_genotype(first: dict, second: dict) -> bool:
+    return np.array_equal(np.asarray(first['genotype'], dtype=np.float64),
+                          np.asarray(second['genotype'], dtype=np.float64))
+
+
+def to_float(value) -> float:
+    # readings are stored as doubles, strings only remain in documents written before the typed migration
+    if isinstance(value, float):
+        return value
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        return float(value.replace(',', '.'))
+    return float(value)
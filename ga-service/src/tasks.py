@@ -1,7 +1,11 @@
+import heapq
+import itertools
 import logging
+import time
 
 import connector
 import enums
+import metrics
 from config import Config
 from sensor import Sensor
 from ga_impl import GeneticAlgorithm
@@ -14,6 +18,10 @@ class TaskQueue:
         self.cfg = Config()
         self.connector = connector.get_connector()
         self.tasks = []
+        self._schedule = []
+        self._scheduled = {}
+        self._sequence = itertools.count()
+        self._next_refresh = 0
         self.generate_tasks()
 
     def __iter__(self):
@@ -22,15 +30,73 @@ class TaskQueue:
     def __next__(self):
         if self.tasks:
             return self.tasks.pop(0)
-        else:
-            self.generate_tasks()
-            return self.__next__()
+        while True:
+            if time.time() >= self._next_refresh:
+                self.refresh()
+            if not self._schedule:
+                time.sleep(max(self._next_refresh - time.time(), 0))
+                continue
+            due, _, key = self._schedule[0]
+            now = time.time()
+            if due > now:
+                time.sleep(max(min(due, self._next_refresh) - now, 0))
+                continue
+            return self._dispatch(due, key, now)
+
+    def pop_due(self):
+        # non-blocking look ahead for the pipeline, only returns scheduled tasks that are already due
+        if self.tasks or not self._schedule:
+            return None
+        due, _, key = self._schedule[0]
+        now = time.time()
+        if due > now:
+            return None
+        return self._dispatch(due, key, now)
+
+    def complete(self, result: dict):
+        # tasks run in this process, nothing is held for them
+        pass
+
+    def _dispatch(self, due: float, key: str, now: float):
+        heapq.heappop(self._schedule)
+        task = self._scheduled[key]
+        self._push(key, max(due + self.interval, now))
+        metrics.queue_lag.set(now - due)
+        metrics.queue_depth.set(self.depth)
+        self.logger.debug('Dispatching {} (lag: {:.1f}s, depth: {})'.format(key, now - due, self.depth))
+        return task
+
+    @property
+    def interval(self) -> int:
+        return self.cfg.time_interval * self.cfg.time_unit.seconds
+
+    @property
+    def depth(self) -> int:
+        now = time.time()
+        return sum(1 for due, _, _ in self._schedule if due <= now)
+
+    @property
+    def lag(self) -> float:
+        if not self._schedule:
+            return 0
+        return max(time.time() - self._schedule[0][0], 0)
+
+    def _push(self, key: str, due: float):
+        heapq.heappush(self._schedule, (due, next(self._sequence), key))
 
     def create_new_genotype(self):
         training_data = [[1, 2, 3], [2, 3, 3], [5, 5, 5]]
         ga = GeneticAlgorithm(training_data, len(training_data[0]))
         self.connector = ga.get_best()
 
+    def refresh(self):
+        # a failed refresh keeps the current schedule running and is retried after the next refresh interval
+        try:
+            self.generate_tasks()
+        except Exception:
+            self.logger.exception('Schedule refresh failed, keeping {} scheduled sensors'.format(len(self._scheduled)))
+            self._next_refresh = time.time() + self.cfg.schedule_refresh
+
     def generate_tasks(self):
         if self.cfg.environment == enums.EnvironmentTypes.DEV \
                 and self.cfg.bootstrap \
@@ -39,10 +105,37 @@ class TaskQueue:
             self.tasks.append(BootstrapTask())
             self._bootstrapped = True
 
-        for sensor in self.connector.get('ALL', self.cfg.config_collection):
+        def read_sensors():
+            return list(self.connector.get('ALL', self.cfg.config_collection))
+
+        sensors = {}
+        for sensor in self.connector.with_retry(read_sensors):
             sensor_obj = Sensor()
             sensor_obj.update(sensor)
-            self.tasks.append(GeneticAlgorithmTask(sensor=sensor_obj))
+            self.connector.ensure_indexes(sensor_obj.datetime_col)
+            sensors['sensor:{}'.format(sensor_obj.id)] = sensor_obj
+
+        for key in set(self._scheduled) - set(sensors):
+            self.logger.info('Sensor removed from schedule: {}'.format(key))
+            self._scheduled.pop(key)
+        for key, sensor_obj in sensors.items():
+            task = self._scheduled.get(key)
+            if task is None:
+                self.logger.info('Sensor added to schedule: {}'.format(key))
+                self._push(key, time.time())
+            elif task.sensor.to_dict() == sensor_obj.to_dict():
+                continue
+            self._scheduled[key] = GeneticAlgorithmTask(sensor=sensor_obj)
+        self._schedule = [entry for entry in self._schedule if entry[2] in self._scheduled]
+        heapq.heapify(self._schedule)
+        self._next_refresh = time.time() + self.cfg.schedule_refresh
+
+
+def get_task_queue() -> TaskQueue:
+    if Config().task_queue == enums.TaskQueueTypes.REDIS:
+        from redis_queue import RedisTaskQueue
+        return RedisTaskQueue()
+    return TaskQueue()
 
 
 class Task:
@@ -52,6 +145,10 @@ class Task:
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+    @property
+    def key(self) -> str:
+        return self.__class__.__name__
+
     def run(self):
         pass
 
@@ -62,10 +159,32 @@ class GeneticAlgorithmTask(Task):
         self.sensor = sensor
         self.connector = connector.get_connector()
 
+    def __getstate__(self):
+        return {'sensor': self.sensor}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def key(self) -> str:
+        return 'sensor:{}'.format(self.sensor.id)
+
     def run(self):
         self.logger.info('{} is running...'.format(__class__.__name__))
-        self.sensor.calculate_new_genotype()
+        summary = self.sensor.calculate_new_genotype()
         self.logger.info('{} completed!'.format(__class__.__name__))
+        return summary
+
+    def prepare(self):
+        return self.sensor.prepare()
+
+    def train(self, prepared: dict):
+        return self.sensor.train(prepared)
+
+    def store(self, prepared: dict, trained: dict):
+        summary = self.sensor.store(prepared, trained)
+        self.logger.info('{} completed!'.format(__class__.__name__))
+        return summary
 
 
 class BootstrapTask(Task):
@@ -76,25 +195,19 @@ class BootstrapTask(Task):
     def run(self):
         self.logger.info('Bootstrapping...')
         self.connector.remove(self.cfg.data_collection)
+        self.connector.remove(self.cfg.buckets_collection)
+        self.connector.remove(self.cfg.predictions_collection)
         self.connector.remove(self.cfg.config_collection)
-        key_dict = {
-            'date': 'date_time',
-            'pm10': 'pm10',
-            'wind direction': 'wind_direction',
-            'wind strength': 'wind',
-            'temp': 'temperature',
-            'humidity': 'humidity',
-            'dew point': 'dew_point',
-            'air pres.': 'pressure'
-        }
-        from bootstrap.bootstrap import get_data_from_csv
-        data = get_data_from_csv(key_dict=key_dict)
-
-        sensor = Sensor(fields=list(data[0].keys()), vendor='bootstrap', vendor_id=0,
+        from bootstrap.bootstrap import import_csvs, get_abs_path, arka_key_dict
+
+        sensor = Sensor(fields=list(arka_key_dict.values()), vendor='bootstrap', vendor_id=0,
                         datetime_col='date_time', predict='pm10')
         sensor.save()
 
-        [d.update({'sensor_id': sensor.id}) for d in data]
+        def write(chunk):
+            sensor.save_readings([sensor.to_reading(d) for d in chunk])
 
-        saved_data = self.connector.save(data, self.cfg.data_collection).inserted_ids
-        self.logger.info('Saved data count: {}'.format(len(saved_data)))
+        saved_data = import_csvs([get_abs_path('daneArka.csv')], write, workers=self.cfg.bootstrap_workers,
+                                 key_dict=arka_key_dict, chunk_size=self.cfg.bootstrap_chunk_size)
+        self.logger.info('Saved data count: {}'.format(saved_data))
+        sensor.update_prediction()
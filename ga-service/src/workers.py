@@ -0,0 +1,134 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from logging.handlers import QueueHandler, QueueListener
+
+import connector
+import metrics
+
+module_logger = logging.getLogger('genetic_algorithm.workers')
+_in_worker = False
+
+
+def init_worker(log_queue: multiprocessing.Queue):
+    # forked workers must not share the parent's Mongo client, and their logs go back to the parent
+    root = logging.getLogger('genetic_algorithm')
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    connector.Connector.reset()
+    global _in_worker
+    _in_worker = True
+
+
+def execute(task) -> dict:
+    if _in_worker:
+        # workers only ship what this task recorded, the parent registry accumulates
+        metrics.registry.reset()
+    started = time.time()
+    result = {'key': task.key, 'ok': True, 'error': None, 'summary': None, 'metrics': None}
+    try:
+        result['summary'] = task.run()
+    except Exception as e:
+        module_logger.exception('{} failed'.format(task.key))
+        result.update({'ok': False, 'error': repr(e)})
+    result['elapsed'] = time.time() - started
+    if _in_worker:
+        result['metrics'] = metrics.registry.snapshot()
+    return result
+
+
+def record(result: dict):
+    if result.get('metrics'):
+        metrics.registry.merge(result['metrics'])
+    metrics.tasks.inc(outcome='ok' if result['ok'] else 'failed')
+    if result.get('elapsed') is not None:
+        metrics.task_seconds.observe(result['elapsed'], phase='total')
+
+
+class TaskPool:
+    def __init__(self, workers: int, on_result=None):
+        self.logger = logging.getLogger('genetic_algorithm.workers.TaskPool')
+        self.workers = workers
+        self.on_result = on_result
+        self._log_queue = multiprocessing.Queue()
+        self._listener = QueueListener(self._log_queue,
+                                       *logging.getLogger('genetic_algorithm').handlers,
+                                       respect_handler_level=True)
+        self._executor = None
+        self._in_flight = {}
+
+    def __enter__(self):
+        self._listener.start()
+        self._executor = self._create_executor()
+        return self
+
+    def __exit__(self, *_):
+        self.join()
+        self._executor.shutdown(wait=True)
+        self._listener.stop()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=init_worker,
+                                   initargs=(self._log_queue,))
+
+    @property
+    def in_flight(self) -> set:
+        return {task.key for task in self._in_flight.values()}
+
+    def submit(self, task) -> bool:
+        while len(self._in_flight) >= self.workers:
+            self.wait()
+        if task.key in self.in_flight:
+            self.logger.debug('{} is already running, skipping'.format(task.key))
+            self.wait()
+            return False
+        try:
+            future = self._executor.submit(execute, task)
+        except BrokenProcessPool:
+            self._restart()
+            future = self._executor.submit(execute, task)
+        self._in_flight[future] = task
+        return True
+
+    def wait(self):
+        if not self._in_flight:
+            return
+        done, _ = wait(list(self._in_flight), return_when=FIRST_COMPLETED)
+        broken = False
+        for future in done:
+            task = self._in_flight.pop(future)
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                broken = True
+                result = {'key': task.key, 'ok': False, 'error': repr(e), 'elapsed': None}
+            self.collect(result)
+        if broken:
+            self._restart()
+
+    def join(self):
+        while self._in_flight:
+            self.wait()
+
+    def collect(self, result: dict):
+        record(result)
+        if self.on_result:
+            self.on_result(result)
+        if result['ok']:
+            self.logger.info('{} completed in {:.1f}s: {}'.format(
+                result['key'], result['elapsed'], result.get('summary')))
+        else:
+            self.logger.error('{} failed: {}'.format(result['key'], result['error']))
+
+    def _restart(self):
+        # a crashed worker process breaks the whole executor, tasks still attached to it are lost
+        self.logger.warning('Worker process died, restarting pool')
+        for task in self._in_flight.values():
+            self.collect({'key': task.key, 'ok': False, 'error': 'worker pool restarted', 'elapsed': None})
+        self._in_flight.clear()
+        self._executor.shutdown(wait=False)
+        self._executor = self._create_executor()
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import connector  # noqa: E402
+from config import Config  # noqa: E402
+
+
+@pytest.fixture
+def cfg(monkeypatch):
+    # settings changed through monkeypatch are restored on the singleton after each test
+    config = Config()
+    monkeypatch.setattr(config, 'environment', config.environment.PROD)
+    return config
+
+
+@pytest.fixture
+def store(monkeypatch):
+    pytest.importorskip('mongomock')
+    from benchmarks import stores
+    db = stores.create_store('mongomock')
+    # mongomock has no explain, the collscan check only makes sense against a server
+    monkeypatch.setattr(db, 'ensure_indexes', lambda datetime_col: None)
+    yield db
+    connector.Connector.reset()
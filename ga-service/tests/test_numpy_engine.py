@@ -0,0 +1,31 @@
+import numpy as np
+
+from engines import NumpyEngine, Individual
+
+
+def test_population_stays_capped_after_seeding(cfg, monkeypatch):
+    monkeypatch.setattr(cfg, 'initial_population_size', 50)
+    monkeypatch.setattr(cfg, 'fitness_sample_size', None)
+    training_data = np.random.default_rng(0).normal(size=(500, 4))
+    engine = NumpyEngine(training_data, 4, seed=0)
+    for individual in engine.individuals():
+        engine.add_individual(Individual(individual['genotype'], individual['fitness']))
+    assert len(engine.genotypes) == 100
+    engine.evolve()
+    assert len(engine.genotypes) == 50
+
+
+def test_finalize_keeps_a_seed_that_is_best_on_the_full_data(cfg, monkeypatch):
+    monkeypatch.setattr(cfg, 'initial_population_size', 20)
+    monkeypatch.setattr(cfg, 'fitness_sample_size', 16)
+    rng = np.random.default_rng(1)
+    features = rng.normal(size=(400, 3))
+    weights = np.array([1.0, -2.0, 0.5])
+    engine = NumpyEngine(np.column_stack([features, features @ weights]), 4, seed=1)
+    engine.add_individual(Individual(weights))
+    # the seed dropped out of the population after being outscored on a mini-batch
+    engine.genotypes = engine.genotypes[:-1]
+    engine.fitness = engine.fitness[:-1]
+    best = engine.finalize(engine.get_best())
+    np.testing.assert_array_equal(best.genotype, weights)
+    assert best.fitness == 0
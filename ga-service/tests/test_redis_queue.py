@@ -0,0 +1,109 @@
+import time
+
+import pytest
+from pymongo.errors import PyMongoError
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from redis_queue import RedisTaskQueue  # noqa: E402
+
+LEASE = 60
+
+
+@pytest.fixture
+def nodes(cfg, store, monkeypatch):
+    monkeypatch.setattr(cfg, 'task_lease', LEASE)
+    monkeypatch.setattr(cfg, 'redis_prefix', 'test')
+    for vendor_id in range(3):
+        store.save({'fields': ['a'], 'predict': 'a', 'vendor': 'test', 'vendor_id': vendor_id,
+                    'datetime_col': 'date_time'}, cfg.config_collection)
+    server = fakeredis.FakeServer()
+    queues = [RedisTaskQueue(fakeredis.FakeRedis(server=server, decode_responses=True)) for _ in range(2)]
+    yield queues
+    for queue in queues:
+        queue.close()
+
+
+def ready(queue) -> list:
+    return queue.redis.lrange(queue._keys['ready'], 0, -1)
+
+
+def test_first_node_schedules_and_each_task_is_claimed_once(nodes):
+    a, b = nodes
+    assert a.is_leader and not b.is_leader
+    claimed = [a.claim(), b.claim(), b.claim()]
+    assert None not in claimed
+    assert len({task.key for task in claimed}) == 3
+    assert a.claim() is None and b.claim() is None
+
+
+def test_running_and_queued_tasks_are_not_enqueued_again(nodes):
+    a, b = nodes
+    running = a.claim()
+    later = time.time() + 10 * a.interval
+
+    a.enqueue_due(later)
+    assert running.key not in ready(a)
+    assert len(ready(a)) == 2
+
+    a.enqueue_due(later + 10 * a.interval)
+    assert len(ready(a)) == 2
+    assert len(set(ready(a))) == 2
+
+
+def test_claim_drops_a_key_already_leased_by_another_node(nodes):
+    a, b = nodes
+    task = a.claim()
+    a.redis.rpush(a._keys['ready'], task.key)
+    claimed = [b.claim(), b.claim(), b.claim()]
+    assert task.key not in [t.key for t in claimed if t is not None]
+    assert claimed[-1] is None
+
+
+def test_expired_lease_is_requeued_and_claimed_by_another_node(nodes):
+    a, b = nodes
+    task = a.claim()
+    others = [b.claim(), b.claim()]
+
+    # a stopped extending its lease while b kept its own alive
+    expired = time.time() + LEASE + 1
+    b.heartbeat(expired)
+    b.reap(expired)
+    assert ready(b) == [task.key]
+
+    a.heartbeat(time.time())
+    assert task.key not in a.held
+
+    retried = b.claim()
+    assert retried.key == task.key
+    assert retried.sensor.to_dict() == task.sensor.to_dict()
+    assert all(t.key in b.held for t in others)
+
+
+def test_heartbeat_extends_leases_and_complete_releases_them(nodes):
+    a, _ = nodes
+    task = a.claim()
+    a.heartbeat(time.time() + LEASE)
+    assert a.redis.zscore(a._keys['leases'], task.key) > time.time() + LEASE
+    a.reap(time.time() + LEASE + 1)
+    assert task.key in a.held
+
+    a.complete({'key': task.key})
+    assert a.redis.zscore(a._keys['leases'], task.key) is None
+    assert task.key not in a.held
+
+
+def test_failing_schedule_refresh_does_not_stop_heartbeats(nodes, monkeypatch):
+    a, _ = nodes
+    task = a.claim()
+    before = a.redis.zscore(a._keys['leases'], task.key)
+
+    def fail():
+        raise PyMongoError('mongo is down')
+
+    monkeypatch.setattr(a, 'generate_tasks', fail)
+    a._next_refresh = 0
+    time.sleep(0.01)
+    a.maintain()
+    assert a.redis.zscore(a._keys['leases'], task.key) > before
+    assert task.key in a.held
@@ -0,0 +1,26 @@
+from ga_impl import StopCondition
+
+
+def run(cfg, monkeypatch, fitness_values, min_improvement=0.01, stagnation=3):
+    monkeypatch.setattr(cfg, 'min_improvement', min_improvement)
+    monkeypatch.setattr(cfg, 'stagnation_generations', stagnation)
+    monkeypatch.setattr(cfg, 'target_fitness', None)
+    monkeypatch.setattr(cfg, 'time_budget', None)
+    stop = StopCondition()
+    for fitness in fitness_values:
+        if stop.update(fitness):
+            break
+    return stop
+
+
+def test_slow_steady_improvement_is_not_stagnation(cfg, monkeypatch):
+    # 0.5% per generation, below min_improvement per step but above it every few steps
+    stop = run(cfg, monkeypatch, [100 * 0.995 ** i for i in range(50)])
+    assert stop.reason is None
+    assert stop.generations == 50
+
+
+def test_no_improvement_stops_after_stagnation_generations(cfg, monkeypatch):
+    stop = run(cfg, monkeypatch, [100, 99.99, 99.98, 99.97, 99.96])
+    assert stop.reason is not None and stop.reason.name == 'STAGNATION'
+    assert stop.generations == 4
@@ -0,0 +1,19 @@
+from pymongo.errors import PyMongoError
+
+from tasks import TaskQueue
+
+
+def test_failing_refresh_keeps_the_schedule(cfg, store, monkeypatch):
+    store.save({'fields': ['a'], 'predict': 'a', 'vendor': 'test', 'vendor_id': 1, 'datetime_col': 'date_time'},
+               cfg.config_collection)
+    queue = TaskQueue()
+
+    def fail(*args, **kwargs):
+        raise PyMongoError('mongo is down')
+
+    monkeypatch.setattr(store, 'get', fail)
+    queue._next_refresh = 0
+    task = next(queue)
+    assert task.sensor.vendor_id == 1
+    assert queue._next_refresh > 0
+    assert list(queue._scheduled) == ['sensor:{}'.format(task.sensor.id)]
@@ -0,0 +1,112 @@
+import datetime
+import time
+
+import numpy as np
+import pytest
+
+from sensor import Sensor, TrainingData
+
+HOUR = 3600
+
+
+@pytest.fixture(autouse=True)
+def utc(monkeypatch):
+    # the legacy loop shifts dates in local time
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def sensor():
+    return Sensor(_id='test', fields=['a', 'b'], predict='c', datetime_col='date_time')
+
+
+def legacy_from_data(data, sensor):
+    # the per-row loop TrainingData.pair replaced, kept verbatim apart from the marked line
+    def to_list(obj: dict, obj_after_24h: dict):
+        lst = [obj.get(k) for k in sensor.fields]
+        lst.append(obj_after_24h.get(sensor.predict))
+        return lst
+
+    def min_date(date):
+        date = datetime.datetime.fromtimestamp(date)
+        date += datetime.timedelta(hours=23, minutes=30)
+        return date.timestamp()
+
+    def max_date(date):
+        date = datetime.datetime.fromtimestamp(date)
+        date += datetime.timedelta(days=1, minutes=30)
+        return date.timestamp()
+
+    def nearest(items, pivot):
+        if items:
+            return min(items, key=lambda x: abs(x.get(sensor.datetime_col) - pivot))
+
+    def equal_date(date):
+        date = datetime.datetime.fromtimestamp(date)
+        date += datetime.timedelta(days=1)
+        return date.timestamp()
+
+    td = []
+    data_size = len(data)
+    if data_size > 1:
+        data.sort(key=lambda x: x.get(sensor.datetime_col))
+    for i in range(data_size):
+        d = data[i]
+        dt = d.get(sensor.datetime_col)
+        max_dt = max_date(dt)
+        min_dt = min_date(dt)
+        j = 0 + i
+        temp = data[j]
+        items = []
+        while temp.get(sensor.datetime_col) < max_dt and j < data_size:
+            temp = data[j]
+            # the loop also took the first reading past max_dt however far away, the window ends at 24h30
+            if min_dt < temp.get(sensor.datetime_col) <= max_dt:
+                items.append(temp)
+            j += 1
+        d_after_24h = nearest(items, equal_date(dt))
+        if d_after_24h:
+            td.append(to_list(d, d_after_24h))
+    return td
+
+
+def irregular_history(seed: int) -> list:
+    rng = np.random.default_rng(seed)
+    start = 1325376000
+    timestamps = start + np.arange(24 * 40) * HOUR
+    timestamps = timestamps[rng.random(len(timestamps)) > 0.15]
+    timestamps = timestamps + rng.integers(-20, 21, len(timestamps)) * 60
+    timestamps = list(timestamps) + list(rng.choice(timestamps, 30))
+    # readings exactly on the window bounds and on both sides of the pivot at equal distance
+    for base in (start + 5 * 24 * HOUR, start + 12 * 24 * HOUR + 17):
+        timestamps += [base, base + 23 * HOUR + 30 * 60, base + 24 * HOUR + 30 * 60]
+    for base in (start + 20 * 24 * HOUR + 5,):
+        timestamps += [base, base + 24 * HOUR - 600, base + 24 * HOUR + 600]
+    rng.shuffle(timestamps)
+    return [{'date_time': int(timestamp), 'a': float(rng.normal()), 'b': float(rng.normal()),
+             'c': float(rng.normal())} for timestamp in timestamps]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_searchsorted_pairing_matches_legacy_loop(sensor, seed):
+    data = irregular_history(seed)
+    expected = np.array(legacy_from_data([dict(row) for row in data], sensor))
+    actual = TrainingData.from_data(data, sensor)
+    assert actual.shape == expected.shape
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_window_bounds(sensor):
+    start = 1325376000
+    data = [{'date_time': start, 'a': 1.0, 'b': 1.0, 'c': 0.0},
+            {'date_time': start + 23 * HOUR + 30 * 60, 'a': 2.0, 'b': 2.0, 'c': 1.0},
+            {'date_time': start + 24 * HOUR + 30 * 60, 'a': 3.0, 'b': 3.0, 'c': 2.0},
+            {'date_time': start + 50 * HOUR, 'a': 4.0, 'b': 4.0, 'c': 3.0}]
+    training_data = TrainingData.from_data(data, sensor)
+    # 23h30 is outside and 24h30 inside, the last reading is more than 24h30 after the others and stays
+    # unpaired where the legacy loop took it as the first reading past the window
+    np.testing.assert_array_equal(training_data, [[1.0, 1.0, 2.0]])
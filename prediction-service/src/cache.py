@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from pymongo.errors import PyMongoError
+from sanic.log import logger
+
+
+class AsyncTTLCache:
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._locks = {}
+
+    async def get(self, key, loader):
+        value = self._lookup(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        # concurrent misses for the same key wait for a single load
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                value = self._lookup(key)
+                if value is not None:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+                value = await loader()
+                if value is not None:
+                    self.set(key, value)
+                return value
+        finally:
+            self._locks.pop(key, None)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix: str):
+        for key in [key for key in self._entries if str(key).startswith(prefix)]:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {'name': self.name,
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+def individual_key(sensor_id, horizon=None) -> str:
+    # individuals are cached per sensor and horizon, the bare prefix matches every horizon of a sensor
+    prefix = '{}:'.format(sensor_id)
+    return prefix if horizon is None else '{}{}'.format(prefix, horizon)
+
+
+class CacheInvalidator:
+    def __init__(self, sensors: AsyncTTLCache, individuals: AsyncTTLCache, poll_interval: float = 10):
+        self.sensors = sensors
+        self.individuals = individuals
+        self.poll_interval = poll_interval
+
+    async def run(self, sensor_coll, individual_coll):
+        watchers = [asyncio.ensure_future(self.watch(sensor_coll, self.on_sensor_change)),
+                    asyncio.ensure_future(self.watch(individual_coll, self.on_individual_change))]
+        try:
+            await asyncio.gather(*watchers)
+        except PyMongoError as e:
+            for watcher in watchers:
+                watcher.cancel()
+            logger.info('Change streams unavailable ({}), polling every {}s'.format(e, self.poll_interval))
+            await self.poll(individual_coll)
+
+    async def watch(self, coll, callback):
+        async with coll.watch(full_document='updateLookup') as stream:
+            async for change in stream:
+                callback(change)
+
+    def on_sensor_change(self, change: dict):
+        sensor_id = str(change['documentKey']['_id'])
+        self.sensors.invalidate(sensor_id)
+        self.individuals.invalidate_prefix(individual_key(sensor_id))
+
+    def on_individual_change(self, change: dict):
+        document = change.get('fullDocument') or {}
+        if 'sensor_id' in document:
+            self.individuals.invalidate_prefix(individual_key(document['sensor_id']))
+        else:
+            self.individuals.invalidate()
+
+    async def poll(self, individual_coll):
+        # sensors are only refreshed by ttl here, new individuals are detected by their increasing _id
+        last = await individual_coll.find_one({}, {'_id': True}, sort=[('_id', -1)])
+        last_id = last['_id'] if last else None
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            query = {'_id': {'$gt': last_id}} if last_id else {}
+            try:
+                async for doc in individual_coll.find(query, {'sensor_id': True}).sort('_id', 1):
+                    last_id = doc['_id']
+                    self.individuals.invalidate_prefix(individual_key(doc.get('sensor_id')))
+            except PyMongoError as e:
+                logger.warning('Cache invalidation poll failed: {}'.format(e))
@@ -5,6 +5,24 @@ db_default = {
     'DB_DATA': 'data',
 }
 
+service_default = {
+    'CACHE_TTL': 300,
+    'CACHE_MAXSIZE': 1024,
+    'CACHE_POLL_INTERVAL': 10,
+    'INGEST_BATCH_SIZE': 1000,
+    'INGEST_MAX_PENDING': 50000,
+    'INGEST_FLUSH_INTERVAL': 1.0,
+    'INGEST_PUT_TIMEOUT': 5.0,
+    'PREDICTION_MAX_AGE': 3600,
+    'STORAGE_LAYOUT': 'ROWS',
+    'BUCKET_SPAN': 'DAY',
+}
+
+
+def load_service_default(cfg: dict):
+    for key, value in service_default.items():
+        cfg.setdefault(key, value)
+
 
 def safe_load_default(cfg: dict):
     if not any(db_param in cfg.keys() for db_param in db_default.keys()):
@@ -1,8 +1,13 @@
 import operator
+import time
+from collections import defaultdict
 
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from sanic_motor import BaseModel
 from sanic_motor import logger
 
+DEFAULT_HORIZON = 24  # hours, the horizon of sensors and individuals stored without one, as in ga-service
 
 class ExtendedModel(BaseModel):
     __entities__ = []
@@ -31,6 +36,16 @@ class ExtendedModel(BaseModel):
         else:
             raise Exception('Base Model has not been initialized.')
 
+    @classmethod
+    async def ensure_sensor_index(cls, datetime_col: str):
+        coll = cls.get_collection()
+        await coll.create_index([('sensor_id', ASCENDING), (datetime_col, DESCENDING)])
+        plan = await coll.find({'sensor_id': None}).sort(datetime_col, DESCENDING).limit(1).explain()
+        if uses_collscan(plan['queryPlanner']['winningPlan']):
+            raise Exception('Entity<{}> query by sensor_id sorted by {} still uses COLLSCAN'.format(
+                cls.__name__, datetime_col))
+        logger.info("Entity<{}> index on (sensor_id, {} desc) ready".format(cls.__name__, datetime_col))
+
     def to_dict(self):
         dct = {}
         for k, v in vars(self).items():
@@ -40,10 +55,21 @@ class ExtendedModel(BaseModel):
         return dct
 
 
+def uses_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        return plan.get('stage') == 'COLLSCAN' or any(uses_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(uses_collscan(v) for v in plan)
+    return False
+
+
 class Sensor(ExtendedModel):
     __coll_env__ = 'COLL_CONFIG'
     __coll_default__ = 'config'
 
+    def horizon_list(self) -> list:
+        return list(getattr(self, 'horizons', None) or [DEFAULT_HORIZON])
+
 
 Sensor.add_entity()
 
@@ -52,6 +78,11 @@ class Individual(ExtendedModel):
     __coll_env__ = 'COLL_INDIVIDUALS'
     __coll_default__ = 'individuals'
 
+    @staticmethod
+    def horizon_filter(horizon=DEFAULT_HORIZON) -> dict:
+        # individuals saved before horizons existed have no horizon field and belong to the default one
+        return {'horizon': {'$in': [horizon, None]} if horizon == DEFAULT_HORIZON else horizon}
+
 
 Individual.add_entity()
 
@@ -61,16 +92,136 @@ class Data(ExtendedModel):
     __coll_default__ = 'data'
 
     def predict(self, sensor: Sensor, individual: Individual):
+        # readings written with a missing column hold None there, like ga-service no prediction is made from them
+        if any(getattr(self, key, None) is None for key in sensor.fields):
+            return None
         return sum(map(operator.mul, individual.genotype, self.to_array(sensor)))
 
     def to_array(self, sensor: Sensor):
         return [self.to_number(key) for key in sensor.fields]
 
+    @staticmethod
+    def from_reading(sensor: Sensor, reading: dict) -> dict:
+        if not isinstance(reading, dict):
+            raise ValueError('Reading must be an object')
+        missing = [field for field in sensor.fields if reading.get(field) is None]
+        if missing:
+            raise ValueError('Missing fields: {}'.format(', '.join(missing)))
+        document = {}
+        for key in dict.fromkeys(list(sensor.fields) + [sensor.predict]):
+            value = reading.get(key)
+            if isinstance(value, str):
+                value = float(value.replace(',', '.'))
+            elif value is not None and not isinstance(value, bool):
+                value = float(value)
+            if value is not None and not isinstance(value, float):
+                raise ValueError('Invalid value for {}: {}'.format(key, value))
+            document[key] = value
+        document[sensor.datetime_col] = reading.get(sensor.datetime_col)
+        if not isinstance(document[sensor.datetime_col], (int, float)):
+            raise ValueError('{} must be a unix timestamp'.format(sensor.datetime_col))
+        document['sensor_id'] = sensor._id
+        return document
+
     def to_number(self, key: str):
+        # readings are written as doubles by the typed ingestion, see ga-service migrate.py for older documents
         v = getattr(self, key, 0)
-        if isinstance(v, str):
-            v = float(v.replace(',', '.'))
-        return v
+        if isinstance(v, (int, float)):
+            return v
+        return float(v)
 
 
 Data.add_entity()
+
+
+class Bucket(ExtendedModel):
+    # readings of one sensor within [start, start + span) stored as column arrays, written by ga-service too
+    __coll_env__ = 'COLL_BUCKETS'
+    __coll_default__ = 'buckets'
+
+    SPANS = {'DAY': 24 * 60 * 60, 'WEEK': 7 * 24 * 60 * 60}
+
+    @classmethod
+    async def ensure_index(cls):
+        await cls.get_collection().create_index([('sensor_id', ASCENDING), ('start', DESCENDING)], unique=True)
+        logger.info("Entity<{}> index on (sensor_id, start desc) ready".format(cls.__name__))
+
+    @staticmethod
+    def schema(sensor: Sensor) -> tuple:
+        # every bucket write pushes all of these, missing values as None, so the arrays stay aligned
+        return tuple(dict.fromkeys([sensor.datetime_col] + list(sensor.fields) + [sensor.predict]))
+
+    @staticmethod
+    def updates(entries: list, span: int) -> list:
+        # entries are (schema, document) pairs, one upsert per (sensor, bucket start)
+        buckets = defaultdict(list)
+        for columns, document in entries:
+            start = int(document[columns[0]] // span * span)
+            buckets[(document['sensor_id'], start, columns)].append(document)
+        operations = []
+        for (sensor_id, start, columns), documents in buckets.items():
+            timestamps = [document[columns[0]] for document in documents]
+            operations.append(UpdateOne(
+                {'sensor_id': sensor_id, 'start': start},
+                {'$set': {'span': span},
+                 '$min': {'min_ts': min(timestamps)},
+                 '$max': {'max_ts': max(timestamps)},
+                 '$inc': {'count': len(documents)},
+                 '$push': {'columns.{}'.format(column): {'$each': [document.get(column) for document in documents]}
+                           for column in columns}},
+                upsert=True))
+        return operations
+
+    def latest(self, sensor: Sensor) -> Data:
+        columns = getattr(self, 'columns', {})
+        timestamps = columns.get(sensor.datetime_col) or []
+        if not timestamps:
+            return None
+        i = max(range(len(timestamps)), key=timestamps.__getitem__)
+        reading = {column: values[i] for column, values in columns.items() if i < len(values)}
+        return Data(sensor_id=self.sensor_id, **reading)
+
+
+Bucket.add_entity()
+
+
+class Prediction(ExtendedModel):
+    # latest prediction per sensor and horizon, written by ga-service after training and here after ingestion
+    __coll_env__ = 'COLL_PREDICTIONS'
+    __coll_default__ = 'predictions'
+
+    @classmethod
+    async def ensure_index(cls):
+        coll = cls.get_collection()
+        if 'sensor_id_1' in await coll.index_information():
+            await coll.drop_index('sensor_id_1')
+        await coll.create_index([('sensor_id', ASCENDING), ('horizon', ASCENDING)], unique=True)
+        logger.info("Entity<{}> index on (sensor_id, horizon) ready".format(cls.__name__))
+
+    @classmethod
+    async def store(cls, sensor: Sensor, individual: Individual, data: Data, value: float,
+                    horizon=DEFAULT_HORIZON) -> bool:
+        # keeps a stored prediction computed from newer inputs, see MongoDB.save_prediction in ga-service
+        reading_ts = getattr(data, sensor.datetime_col)
+        individual_ts = getattr(individual, sensor.datetime_col)
+        query = {'sensor_id': sensor._id,
+                 'horizon': horizon,
+                 'reading_ts': {'$lte': reading_ts},
+                 'individual_ts': {'$lte': individual_ts}}
+        prediction = {'sensor_id': sensor._id,
+                      'horizon': horizon,
+                      'value': value,
+                      'reading_ts': reading_ts,
+                      'individual_ts': individual_ts,
+                      'computed_at': time.time()}
+        try:
+            await cls.get_collection().replace_one(query, prediction, upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def is_fresh(self, max_age: float) -> bool:
+        return time.time() - getattr(self, 'computed_at', 0) <= max_age
+
+
+Prediction.add_entity()
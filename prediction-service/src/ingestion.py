@@ -0,0 +1,113 @@
+import asyncio
+
+from pymongo.errors import BulkWriteError, PyMongoError
+from sanic.log import logger
+
+
+class BufferFull(Exception):
+    pass
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class WriteBuffer:
+    def __init__(self, model, batch_size: int = 1000, max_pending: int = 50000,
+                 flush_interval: float = 1.0, put_timeout: float = 5.0, on_flush=None):
+        self.model = model
+        self.on_flush = on_flush
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.written = 0
+        self.failed = 0
+        self._pending = []
+        self._flush_now = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+
+    async def put(self, documents: list):
+        if len(documents) > self.max_pending:
+            raise RequestTooLarge('Request larger than the write buffer ({} documents)'.format(self.max_pending))
+        async with self._space:
+            try:
+                await asyncio.wait_for(
+                    self._space.wait_for(lambda: len(self._pending) + len(documents) <= self.max_pending),
+                    self.put_timeout)
+            except asyncio.TimeoutError:
+                raise BufferFull('Write buffer full, retry later')
+            self._pending.extend(documents)
+        if len(self._pending) >= self.batch_size:
+            self._flush_now.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            sensor_ids = set()
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                await self._insert(batch)
+                sensor_ids.update(self.sensor_ids(batch))
+                async with self._space:
+                    self._space.notify_all()
+            if sensor_ids and self.on_flush:
+                try:
+                    await self.on_flush(sensor_ids)
+                except Exception as e:
+                    logger.error('Flush callback failed: {}'.format(e))
+
+    async def _insert(self, batch: list):
+        try:
+            result = await self.model.get_collection().insert_many(batch, ordered=False)
+            self.written += len(result.inserted_ids)
+        except BulkWriteError as e:
+            inserted = e.details.get('nInserted', 0)
+            self.written += inserted
+            self.failed += len(batch) - inserted
+            logger.warning('Bulk insert: {} of {} documents failed'.format(len(batch) - inserted, len(batch)))
+        except PyMongoError as e:
+            self.failed += len(batch)
+            logger.error('Bulk insert of {} documents failed: {}'.format(len(batch), e))
+
+    def entries(self, sensor, documents: list) -> list:
+        return documents
+
+    def sensor_ids(self, batch: list) -> set:
+        return {document['sensor_id'] for document in batch}
+
+    def stats(self) -> dict:
+        return {'pending': len(self._pending),
+                'written': self.written,
+                'failed': self.failed}
+
+
+class BucketWriteBuffer(WriteBuffer):
+    def __init__(self, model, span: int, **kwargs):
+        super().__init__(model, **kwargs)
+        self.span = span
+
+    def entries(self, sensor, documents: list) -> list:
+        return [(self.model.schema(sensor), document) for document in documents]
+
+    def sensor_ids(self, batch: list) -> set:
+        return {document['sensor_id'] for _, document in batch}
+
+    async def _insert(self, batch: list):
+        try:
+            await self.model.get_collection().bulk_write(self.model.updates(batch, self.span), ordered=False)
+            self.written += len(batch)
+        except PyMongoError as e:
+            # a partially applied bulk write cannot be mapped back to readings, count the batch as failed
+            self.failed += len(batch)
+            logger.error('Bucket write of {} readings failed: {}'.format(len(batch), e))
@@ -1,10 +1,15 @@
+from collections import defaultdict
+
+from bson import ObjectId
 from sanic import Sanic
 from sanic.log import logger
 from sanic.response import json
 
 import entities
-from default import safe_load_default
-from entities import Sensor, Individual, Data
+from cache import AsyncTTLCache, CacheInvalidator, individual_key
+from default import safe_load_default, load_service_default
+from entities import Sensor, Individual, Data, Bucket, Prediction, DEFAULT_HORIZON
+from ingestion import WriteBuffer, BucketWriteBuffer, BufferFull, RequestTooLarge
 
 app = Sanic()
 is_dev = None
@@ -13,8 +18,155 @@ if app.config.get('ENVIRONMENT', '').upper() == 'DEV':
     safe_load_default(app.config)
     is_dev = True
 
+load_service_default(app.config)
 entities.ExtendedModel.init_app(app)
 
+sensor_cache = AsyncTTLCache('sensors', app.config['CACHE_MAXSIZE'], app.config['CACHE_TTL'])
+individual_cache = AsyncTTLCache('individuals', app.config['CACHE_MAXSIZE'], app.config['CACHE_TTL'])
+invalidator = CacheInvalidator(sensor_cache, individual_cache, app.config['CACHE_POLL_INTERVAL'])
+use_buckets = app.config['STORAGE_LAYOUT'].upper() == 'BUCKETS'
+buffer_options = dict(batch_size=app.config['INGEST_BATCH_SIZE'],
+                      max_pending=app.config['INGEST_MAX_PENDING'],
+                      flush_interval=app.config['INGEST_FLUSH_INTERVAL'],
+                      put_timeout=app.config['INGEST_PUT_TIMEOUT'])
+if use_buckets:
+    data_buffer = BucketWriteBuffer(Bucket, Bucket.SPANS[app.config['BUCKET_SPAN'].upper()], **buffer_options)
+else:
+    data_buffer = WriteBuffer(Data, **buffer_options)
+
+
+@app.listener('before_server_start')
+async def ensure_indexes(app, loop):
+    datetime_cols = set(await Sensor.get_collection().distinct('datetime_col')) | {'date_time'}
+    for datetime_col in datetime_cols:
+        await Individual.ensure_sensor_index(datetime_col)
+        await Data.ensure_sensor_index(datetime_col)
+    if use_buckets:
+        await Bucket.ensure_index()
+    await Prediction.ensure_index()
+
+
+@app.listener('after_server_start')
+async def start_cache_invalidator(app, loop):
+    app.invalidator_task = loop.create_task(
+        invalidator.run(Sensor.get_collection(), Individual.get_collection()))
+
+
+@app.listener('before_server_stop')
+async def stop_cache_invalidator(app, loop):
+    app.invalidator_task.cancel()
+
+
+@app.listener('after_server_start')
+async def start_data_buffer(app, loop):
+    app.data_buffer_task = loop.create_task(data_buffer.run())
+
+
+@app.listener('before_server_stop')
+async def stop_data_buffer(app, loop):
+    app.data_buffer_task.cancel()
+    await data_buffer.flush()
+
+
+async def get_cached_sensor(sensor_id: str):
+    return await sensor_cache.get(sensor_id, lambda: Sensor.find_one(sensor_id))
+
+
+async def get_cached_individual(sensor: Sensor, horizon=DEFAULT_HORIZON):
+    async def load():
+        query = dict({'sensor_id': sensor._id}, **Individual.horizon_filter(horizon))
+        individuals = await Individual.find(filter=query,
+                                            sort='{} desc'.format(sensor.datetime_col), limit=1)
+        return individuals.objects[0] if individuals.objects else None
+
+    return await individual_cache.get(individual_key(sensor._id, horizon), load)
+
+
+def parse_horizon(value):
+    if value is None:
+        return DEFAULT_HORIZON
+    horizon = float(value)
+    return int(horizon) if horizon.is_integer() else horizon
+
+
+async def find_latest(model, sensors: list, match: dict = None) -> dict:
+    # one aggregation per distinct datetime_col, in practice a single query per collection
+    sensor_ids = defaultdict(list)
+    for sensor in sensors:
+        sensor_ids[sensor.datetime_col].append(sensor._id)
+    latest = {}
+    for datetime_col, ids in sensor_ids.items():
+        docs = await model.aggregate([
+            {'$match': dict(match or {}, sensor_id={'$in': ids})},
+            {'$sort': {'sensor_id': 1, datetime_col: -1}},
+            {'$group': {'_id': '$sensor_id', 'latest': {'$first': '$$ROOT'}}},
+        ])
+        latest.update({doc['_id']: model(**doc['latest']) for doc in docs})
+    return latest
+
+
+async def find_latest_data(sensors: list) -> dict:
+    if not use_buckets:
+        return await find_latest(Data, sensors)
+    by_id = {sensor._id: sensor for sensor in sensors}
+    docs = await Bucket.aggregate([
+        {'$match': {'sensor_id': {'$in': list(by_id)}}},
+        {'$sort': {'sensor_id': 1, 'start': -1}},
+        {'$group': {'_id': '$sensor_id', 'latest': {'$first': '$$ROOT'}}},
+    ])
+    latest = {doc['_id']: Bucket(**doc['latest']).latest(by_id[doc['_id']]) for doc in docs}
+    return {sensor_id: d for sensor_id, d in latest.items() if d is not None}
+
+
+async def get_latest_data(sensor: Sensor):
+    if use_buckets:
+        buckets = await Bucket.find(filter={'sensor_id': sensor._id}, sort='start desc', limit=1)
+        return buckets.objects[0].latest(sensor) if buckets.objects else None
+    data = await Data.find(filter={'sensor_id': sensor._id}, sort='{} desc'.format(sensor.datetime_col), limit=1)
+    return data.objects[0] if data.objects else None
+
+
+async def get_stored_predictions(sensors: list, horizon=DEFAULT_HORIZON) -> dict:
+    max_age = app.config['PREDICTION_MAX_AGE']
+    predictions = await Prediction.find(filter={'sensor_id': {'$in': [sensor._id for sensor in sensors]},
+                                                'horizon': horizon})
+    return {prediction.sensor_id: prediction for prediction in predictions.objects
+            if prediction.is_fresh(max_age)}
+
+
+async def compute_prediction(sensor: Sensor, individual: Individual, d: Data, horizon=DEFAULT_HORIZON):
+    predicted = d.predict(sensor, individual)
+    if predicted is not None:
+        await Prediction.store(sensor, individual, d, predicted, horizon)
+    return predicted
+
+
+async def refresh_predictions(sensor_ids: set):
+    # new readings change the answer, recompute once per flush instead of on every request
+    for sensor_id in sensor_ids:
+        sensor = await get_cached_sensor(str(sensor_id))
+        if not sensor:
+            continue
+        d = await get_latest_data(sensor)
+        if d is None:
+            continue
+        for horizon in sensor.horizon_list():
+            individual = await get_cached_individual(sensor, horizon)
+            if individual is not None:
+                await compute_prediction(sensor, individual, d, horizon)
+
+
+data_buffer.on_flush = refresh_predictions
+
+
+def is_safe_filter(query) -> bool:
+    if isinstance(query, dict):
+        return all(key not in ('$where', '$function', '$accumulator') and is_safe_filter(value)
+                   for key, value in query.items())
+    if isinstance(query, list):
+        return all(is_safe_filter(value) for value in query)
+    return True
+
 
 @app.route("api/sensors/find")
 async def get_sensor_query(request):
@@ -45,20 +197,34 @@ async def get_all_sensors(request):
 
 @app.route("/api/sensors/predict/<sensor_id>", methods=['GET'])
 async def predict(request, sensor_id):
-    sensor = await Sensor.find_one(sensor_id)
+    try:
+        horizon = parse_horizon(request.args.get('horizon'))
+    except ValueError:
+        return json({'sensorId': sensor_id,
+                     'error': 'Horizon must be a number of hours'},
+                    status=400)
+    sensor = await get_cached_sensor(sensor_id)
     predicted = None
     if sensor:
-        sort_query = '{} desc'.format(sensor.datetime_col)
-
-        individual = await Individual.find(sort=sort_query, limit=1)
-        data = await Data.find(sort=sort_query, limit=1)
-
-        for d, i in zip(data.objects, individual.objects):
-            predicted = d.predict(sensor, i)
-            if is_dev:
-                logger.info({'sensorId': sensor_id, 'data': d.to_dict(), 'individual': i.to_dict()})
-        if predicted:
+        if horizon not in sensor.horizon_list():
+            return json({'sensorId': sensor_id,
+                         'error': 'Sensor is trained for horizons: {}'.format(sensor.horizon_list())},
+                        status=400)
+        stored = (await get_stored_predictions([sensor], horizon)).get(sensor._id)
+        if stored is not None:
             return json({'sensorId': sensor_id,
+                         'horizon': horizon,
+                         'predictedValue': stored.value})
+        individual = await get_cached_individual(sensor, horizon)
+        if individual is not None:
+            d = await get_latest_data(sensor)
+            if d is not None:
+                predicted = await compute_prediction(sensor, individual, d, horizon)
+                if is_dev:
+                    logger.info({'sensorId': sensor_id, 'data': d.to_dict(), 'individual': individual.to_dict()})
+        if predicted is not None:
+            return json({'sensorId': sensor_id,
+                         'horizon': horizon,
                          'predictedValue': predicted})
         else:
             return json({'sensorId': sensor_id,
@@ -70,5 +236,120 @@ async def predict(request, sensor_id):
                     status=404)
 
 
+@app.route("/api/sensors/predict", methods=['POST'])
+async def predict_many(request):
+    body = request.json or {}
+    if isinstance(body.get('ids'), list):
+        ids = [str(sensor_id) for sensor_id in body['ids']]
+        query = {'_id': {'$in': [ObjectId(i) if ObjectId.is_valid(i) else i for i in ids]}}
+    elif isinstance(body.get('filter'), dict) and is_safe_filter(body['filter']):
+        ids = None
+        query = body['filter']
+    else:
+        return json({'error': 'Expected a list of "ids" or a sensor "filter".'},
+                    status=400)
+    try:
+        horizon = parse_horizon(body.get('horizon'))
+    except (ValueError, TypeError):
+        return json({'error': 'Horizon must be a number of hours'},
+                    status=400)
+
+    sensors = (await Sensor.find(filter=query)).objects
+    trained = [sensor for sensor in sensors if horizon in sensor.horizon_list()]
+    stored = await get_stored_predictions(trained, horizon)
+    missing = [sensor for sensor in trained if sensor._id not in stored]
+    individuals = await find_latest(Individual, missing, Individual.horizon_filter(horizon)) if missing else {}
+    data = await find_latest_data(missing) if missing else {}
+
+    results = []
+    for sensor in sensors:
+        sensor_id = str(sensor._id)
+        if horizon not in sensor.horizon_list():
+            results.append({'sensorId': sensor_id,
+                            'error': 'Sensor is trained for horizons: {}'.format(sensor.horizon_list())})
+            continue
+        if sensor._id in stored:
+            results.append({'sensorId': sensor_id,
+                            'horizon': horizon,
+                            'predictedValue': stored[sensor._id].value})
+            continue
+        individual = individuals.get(sensor._id)
+        d = data.get(sensor._id)
+        if individual is not None:
+            individual_cache.set(individual_key(sensor_id, horizon), individual)
+        predicted = None
+        if individual is not None and d is not None:
+            predicted = await compute_prediction(sensor, individual, d, horizon)
+        if predicted is None:
+            results.append({'sensorId': sensor_id,
+                            'error': 'Unable to predict value. Invalid data'})
+        else:
+            results.append({'sensorId': sensor_id,
+                            'horizon': horizon,
+                            'predictedValue': predicted})
+    if ids is not None:
+        found = {str(sensor._id) for sensor in sensors}
+        results.extend({'sensorId': sensor_id,
+                        'error': 'Sensor with this id does not exist'}
+                       for sensor_id in ids if sensor_id not in found)
+    return json(results)
+
+
+async def ingest(sensor_id: str, readings: list):
+    sensor = await get_cached_sensor(sensor_id)
+    if not sensor:
+        return json({'sensorId': sensor_id,
+                     'error': 'Sensor with this id does not exist'},
+                    status=404)
+    documents = []
+    errors = []
+    for index, reading in enumerate(readings):
+        try:
+            documents.append(Data.from_reading(sensor, reading))
+        except (ValueError, TypeError) as e:
+            errors.append({'index': index, 'error': str(e)})
+    if documents:
+        try:
+            await data_buffer.put(data_buffer.entries(sensor, documents))
+        except BufferFull as e:
+            return json({'sensorId': sensor_id,
+                         'error': str(e)},
+                        status=503, headers={'Retry-After': '1'})
+        except RequestTooLarge as e:
+            # retrying does not help, the client has to split the request
+            return json({'sensorId': sensor_id,
+                         'error': str(e)},
+                        status=413)
+    return json({'sensorId': sensor_id,
+                 'accepted': len(documents),
+                 'rejected': len(errors),
+                 'errors': errors[:100]},
+                status=202 if documents else 400)
+
+
+@app.route("/api/sensors/<sensor_id>/data", methods=['POST'])
+async def post_data(request, sensor_id):
+    return await ingest(sensor_id, [request.json])
+
+
+@app.route("/api/sensors/<sensor_id>/data/bulk", methods=['POST'])
+async def post_data_bulk(request, sensor_id):
+    if not isinstance(request.json, list):
+        return json({'sensorId': sensor_id,
+                     'error': 'Expected a list of readings'},
+                    status=400)
+    return await ingest(sensor_id, request.json)
+
+
+@app.route("/api/ingestion/stats", methods=['GET'])
+async def get_ingestion_stats(request):
+    return json(data_buffer.stats())
+
+
+@app.route("/api/cache/stats", methods=['GET'])
+async def get_cache_stats(request):
+    return json([sensor_cache.stats(), individual_cache.stats()])
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)